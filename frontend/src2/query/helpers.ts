@@ -42,6 +42,8 @@ import {
 	OrderByArgs,
 	PivotWider,
 	PivotWiderArgs,
+	QueryResultColumn,
+	QueryResultRow,
 	QueryTableArgs,
 	Remove,
 	RemoveArgs,
@@ -96,6 +98,21 @@ export const expression = (expression: string): Expression => ({
 // 	order_by: options.order_by,
 // })
 
+export function getRowsFromColumnarData(columns: QueryResultColumn[], data: any[][]) {
+	if (!columns?.length || !data?.length) return []
+
+	const rowCount = data[0].length
+	const rows: QueryResultRow[] = new Array(rowCount)
+	for (let i = 0; i < rowCount; i++) {
+		const row: QueryResultRow = {}
+		columns.forEach((column, j) => {
+			row[column.name] = data[j][i]
+		})
+		rows[i] = row
+	}
+	return rows
+}
+
 export function getFormattedRows(query: Query) {
 	const result = query.result
 
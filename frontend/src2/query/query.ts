@@ -34,6 +34,7 @@ import {
 	custom_operation,
 	filter_group,
 	getFormattedRows,
+	getRowsFromColumnarData,
 	join,
 	limit,
 	mutate,
@@ -78,6 +79,7 @@ export function makeQuery(workbookQuery: WorkbookQuery) {
 
 		getOperationsForExecution,
 		execute,
+		fetchNextPage,
 		setOperations,
 		setActiveOperation,
 		setActiveEditIndex,
@@ -188,6 +190,7 @@ export function makeQuery(workbookQuery: WorkbookQuery) {
 		() => query.autoExecute && execute(),
 		{ deep: true }
 	)
+	wheneverChanges(() => query.doc.approximate, () => query.autoExecute && execute())
 
 	function getOperationsForExecution(): Operation[] {
 		if (!query.doc.operations.length) {
@@ -258,14 +261,18 @@ export function makeQuery(workbookQuery: WorkbookQuery) {
 		return call('insights.api.workbooks.fetch_query_results', {
 			use_live_connection: query.doc.use_live_connection,
 			operations: query.getOperationsForExecution(),
+			result_format: 'columnar',
+			approximate: query.doc.approximate,
 		})
 			.then((response: any) => {
 				if (!response) return
 				query.result.executedSQL = response.sql
 				query.result.columns = response.columns
-				query.result.rows = response.rows
+				query.result.rows = getRowsFromColumnarData(response.columns, response.data)
 				query.result.formattedRows = getFormattedRows(query)
 				query.result.totalRowCount = response.total_row_count
+				query.result.nextCursor = response.next_cursor
+				query.result.approximate = response.approximate
 				query.result.columnOptions = query.result.columns.map((column) => ({
 					label: column.name,
 					value: column.name,
@@ -283,6 +290,30 @@ export function makeQuery(workbookQuery: WorkbookQuery) {
 			})
 	}
 
+	async function fetchNextPage() {
+		if (query.executing || query.result.rows.length >= query.result.totalRowCount) return
+
+		query.executing = true
+		return call('insights.api.workbooks.fetch_query_results_page', {
+			use_live_connection: query.doc.use_live_connection,
+			operations: query.getOperationsForExecution(),
+			// the first page is fetched by execute, so the next one starts after its rows
+			cursor: query.result.nextCursor || { offset: query.result.rows.length },
+			result_format: 'columnar',
+			approximate: query.doc.approximate,
+		})
+			.then((response: any) => {
+				if (!response) return
+				query.result.rows.push(...getRowsFromColumnarData(response.columns, response.data))
+				query.result.formattedRows = getFormattedRows(query)
+				query.result.nextCursor = response.next_cursor
+			})
+			.catch(showErrorToast)
+			.finally(() => {
+				query.executing = false
+			})
+	}
+
 	function setActiveOperation(index: number) {
 		query.activeOperationIdx = index
 		query.activeEditIndex = -1
@@ -585,21 +616,37 @@ export function makeQuery(workbookQuery: WorkbookQuery) {
 		query.setOperations(newOperations)
 	}
 
-	function downloadResults() {
-		return call('insights.api.workbooks.download_query_results', {
-			use_live_connection: query.doc.use_live_connection,
-			operations: query.getOperationsForExecution(),
-		}).then((csv_data: string) => {
-			const blob = new Blob([csv_data], { type: 'text/csv' })
-			const url = window.URL.createObjectURL(blob)
-			const a = document.createElement('a')
-			a.setAttribute('hidden', '')
-			a.setAttribute('href', url)
-			a.setAttribute('download', `${query.doc.title || 'data'}.csv`)
-			document.body.appendChild(a)
-			a.click()
-			document.body.removeChild(a)
+	function downloadResults(fileFormat: 'csv' | 'parquet' | 'xlsx' = 'csv') {
+		// the file is streamed by the server, so it is fetched directly instead of using `call`
+		return fetch('/api/method/insights.api.workbooks.download_query_results', {
+			method: 'POST',
+			headers: {
+				'Content-Type': 'application/json',
+				'X-Frappe-CSRF-Token': (window as any).csrf_token,
+			},
+			body: JSON.stringify({
+				use_live_connection: query.doc.use_live_connection,
+				operations: query.getOperationsForExecution(),
+				file_format: fileFormat,
+				filename: query.doc.title,
+			}),
 		})
+			.then((response) => {
+				if (!response.ok) throw new Error('Failed to download results')
+				return response.blob()
+			})
+			.then((blob: Blob) => {
+				const url = window.URL.createObjectURL(blob)
+				const a = document.createElement('a')
+				a.setAttribute('hidden', '')
+				a.setAttribute('href', url)
+				a.setAttribute('download', `${query.doc.title || 'data'}.${fileFormat}`)
+				document.body.appendChild(a)
+				a.click()
+				document.body.removeChild(a)
+				window.URL.revokeObjectURL(url)
+			})
+			.catch(showErrorToast)
 	}
 
 	function getDistinctColumnValues(column: string, search_term: string = '', limit: number = 20) {
@@ -699,6 +746,8 @@ const EMPTY_RESULT = {
 	formattedRows: [],
 	columns: [],
 	columnOptions: [],
+	nextCursor: null,
+	approximate: false,
 } as QueryResult
 
 export type Query = ReturnType<typeof makeQuery>
@@ -190,4 +190,6 @@ export type QueryResult = {
 	formattedRows: QueryResultRow[]
 	columns: QueryResultColumn[]
 	columnOptions: ColumnOption[]
+	nextCursor?: Record<string, any> | null
+	approximate?: boolean
 }
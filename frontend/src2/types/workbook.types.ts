@@ -26,6 +26,7 @@ export type WorkbookQuery = {
 	title?: string
 	operations: Operation[]
 	use_live_connection?: boolean
+	approximate?: boolean
 	calculated_measures?: Record<string, Measure>
 }
 
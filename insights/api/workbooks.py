@@ -3,69 +3,326 @@ import ibis
 from ibis import _
 
 from insights.decorators import insights_whitelist
+from insights.insights.doctype.insights_data_source_v3 import query_jobs
+from insights.insights.doctype.insights_data_source_v3.column_stats import (
+    get_source_column_stats,
+)
+from insights.insights.doctype.insights_data_source_v3.column_values import (
+    COLUMN_VALUES_EXPIRY,
+    WAREHOUSE_VALUES_EXPIRY,
+    match_values,
+    search_column_values,
+)
 from insights.insights.doctype.insights_data_source_v3.ibis_utils import (
-    IbisQueryBuilder,
     execute_ibis_query,
     get_columns_from_schema,
+    to_arrow_ipc,
+    to_columnar,
+    to_dataframe,
+)
+from insights.insights.doctype.insights_data_source_v3.insights_data_source_v3 import (
+    after_request,
+    before_request,
+)
+from insights.insights.doctype.insights_data_source_v3.query_batch import (
+    run_query_batch,
+)
+from insights.insights.doctype.insights_data_source_v3.query_export import (
+    export_query,
+    get_export_response,
+)
+from insights.insights.doctype.insights_data_source_v3.query_pagination import (
+    fetch_page,
+)
+from insights.insights.doctype.insights_data_source_v3.query_plan_cache import (
+    get_query_plan,
+    record_plan_usage,
 )
 
 
 @insights_whitelist()
-def fetch_query_results(operations, use_live_connection=True):
-    results = []
-    ibis_query = IbisQueryBuilder().build(operations, use_live_connection)
-    if ibis_query is None:
+def fetch_query_results(
+    operations,
+    use_live_connection=True,
+    count_mode="window",
+    result_format="records",
+    approximate=False,
+    sample_fraction=None,
+):
+    # count_mode:
+    # - window: fetch the total count along with the rows using count(*) over ()
+    # - separate: run a separate count query after fetching the rows
+    # - deferred: skip the count, client can call `fetch_query_results_count`
+    #
+    # result_format:
+    # - records: list of row dicts in `rows`
+    # - columnar: list of column values in `data`, ordered as `columns`
+    # - arrow: arrow ipc stream, rest of the response is in the schema metadata
+    #
+    # approximate: use approximate distinct counts and read a sample (about 100k rows
+    # by default) of the source table, the response is marked `approximate`
+    if count_mode not in ("window", "separate", "deferred"):
+        frappe.throw(f"Invalid count mode: {count_mode}")
+    if result_format not in ("records", "columnar", "arrow"):
+        frappe.throw(f"Invalid result format: {result_format}")
+
+    plan = get_query_plan(operations, use_live_connection, approximate, sample_fraction)
+    if plan is None:
+        return
+
+    as_arrow = result_format != "records"
+    results, total_count, next_cursor = execute_query_plan(plan, count_mode, as_arrow)
+    response = get_results_response(plan, results, total_count, result_format)
+    response["next_cursor"] = next_cursor
+
+    if result_format == "arrow":
+        frappe.response.type = "binary"
+        frappe.response.filename = "results.arrow"
+        frappe.response.filecontent = to_arrow_ipc(results, response)
+        frappe.response.display_content_as = "inline"
+        return
+
+    return response
+
+
+def execute_query_plan(plan, count_mode="window", as_arrow=False):
+    record_plan_usage(plan)
+    # the rows are the first page of the results,
+    # so that the next pages follow on from them
+    results, next_cursor, total_count = fetch_page(
+        plan, with_count=count_mode == "window"
+    )
+    if count_mode == "separate":
+        total_count = get_total_count(plan.query)
+    if total_count is not None:
+        total_count = plan.get_estimated_count(total_count)
+    if not as_arrow:
+        results = to_dataframe(results)
+    return results, total_count, next_cursor
+
+
+def get_results_response(plan, results, total_count, result_format="records"):
+    response = {
+        "sql": plan.sql,
+        "columns": get_columns_from_schema(plan.schema),
+        "total_row_count": int(total_count) if total_count is not None else None,
+        "approximate": plan.approximate,
+        "sample_fraction": plan.sample_fraction,
+    }
+    if result_format == "columnar":
+        response["data"] = to_columnar(results)
+    if result_format == "records":
+        response["rows"] = results.to_dict(orient="records")
+    return response
+
+
+@insights_whitelist()
+def fetch_query_results_batch(queries, result_format="records", batch_id=None):
+    # queries: list of {name, operations, use_live_connection, approximate}
+    # batch_id: if set, each result is also published on `insights_query_batch_result`
+    # as soon as it completes, and the response only has the status of each query
+    if result_format not in ("records", "columnar"):
+        frappe.throw(f"Invalid result format: {result_format}")
+
+    queries = frappe.parse_json(queries)
+
+    def execute(plan):
+        as_arrow = result_format != "records"
+        results, total_count, next_cursor = execute_query_plan(plan, "window", as_arrow)
+        response = get_results_response(plan, results, total_count, result_format)
+        response["next_cursor"] = next_cursor
+        return response
+
+    def publish_result(names, result):
+        frappe.publish_realtime(
+            event="insights_query_batch_result",
+            user=frappe.session.user,
+            message={"batch_id": batch_id, "queries": names, "result": result},
+        )
+
+    results = run_query_batch(queries, execute, publish_result if batch_id else None)
+    if batch_id:
+        return {
+            name: {"error": result["error"]} if result and "error" in result else {}
+            for name, result in results.items()
+        }
+    return results
+
+
+@insights_whitelist()
+def fetch_query_results_page(
+    operations,
+    use_live_connection=True,
+    page_size=100,
+    cursor=None,
+    result_format="records",
+    approximate=False,
+    sample_fraction=None,
+):
+    # cursor is the `next_cursor` of the previous page,
+    # or {"offset": n} to start at any row
+    if result_format not in ("records", "columnar"):
+        frappe.throw(f"Invalid result format: {result_format}")
+
+    plan = get_query_plan(operations, use_live_connection, approximate, sample_fraction)
+    if plan is None:
         return
 
-    columns = get_columns_from_schema(ibis_query.schema())
-    results = execute_ibis_query(ibis_query, cache=True, cache_expiry=60 * 5)
-    results = results.to_dict(orient="records")
+    cursor = frappe.parse_json(cursor) if cursor else None
+    results, next_cursor = fetch_page(plan, page_size, cursor)[:2]
+    if result_format == "records":
+        results = to_dataframe(results)
+
+    response = get_results_response(plan, results, None, result_format)
+    response["next_cursor"] = next_cursor
+    return response
+
 
+@insights_whitelist()
+def fetch_query_results_count(
+    operations, use_live_connection=True, approximate=False, sample_fraction=None
+):
+    plan = get_query_plan(operations, use_live_connection, approximate, sample_fraction)
+    if plan is None:
+        return 0
+    return int(plan.get_estimated_count(get_total_count(plan.query)))
+
+
+def get_total_count(ibis_query):
     count_query = ibis_query.aggregate(count=_.count())
     count_results = execute_ibis_query(count_query, cache=True, cache_expiry=60 * 5)
-    total_count = count_results.values[0][0]
+    return count_results.values[0][0]
 
-    return {
-        "sql": ibis.to_sql(ibis_query),
-        "columns": columns,
-        "rows": results,
-        "total_row_count": int(total_count),
-    }
+
+@insights_whitelist()
+def submit_query_job(operations, use_live_connection=True, result_format="records"):
+    if result_format not in ("records", "columnar"):
+        frappe.throw(f"Invalid result format for a query job: {result_format}")
+
+    job_id = query_jobs.create_query_job()
+    frappe.enqueue(
+        "insights.api.workbooks.run_query_job",
+        queue="long",
+        timeout=query_jobs.QUERY_JOB_TIMEOUT,
+        job_id=query_jobs.get_rq_job_id(job_id),
+        query_job_id=job_id,
+        operations=operations,
+        use_live_connection=use_live_connection,
+        result_format=result_format,
+    )
+    return job_id
+
+
+@insights_whitelist()
+def get_query_job_status(job_id):
+    return query_jobs.get_query_job(job_id)
 
 
 @insights_whitelist()
-def download_query_results(operations, use_live_connection=True):
-    ibis_query = IbisQueryBuilder().build(operations, use_live_connection)
-    if ibis_query is None:
+def cancel_query_job(job_id):
+    return query_jobs.cancel_query_job(job_id)
+
+
+def run_query_job(
+    query_job_id, operations, use_live_connection=True, result_format="records"
+):
+    if query_jobs.is_query_job_cancelled(query_job_id):
+        return
+
+    # connections are set up per request, do the same for the job
+    before_request()
+    try:
+        query_jobs.update_query_job(query_job_id, status="Running")
+        plan = get_query_plan(operations, use_live_connection)
+        if plan is None:
+            query_jobs.update_query_job(query_job_id, status="Completed")
+            return
+
+        query_jobs.set_query_job_processes(query_job_id, plan)
+        # the rows are sent as soon as they are fetched, the count follows
+        as_arrow = result_format != "records"
+        results = execute_query_plan(plan, "deferred", as_arrow)[0]
+        result = get_results_response(plan, results, None, result_format)
+        if query_jobs.is_query_job_cancelled(query_job_id):
+            return
+        query_jobs.update_query_job(query_job_id, result=result)
+
+        result["total_row_count"] = int(get_total_count(plan.query))
+        if query_jobs.is_query_job_cancelled(query_job_id):
+            return
+        query_jobs.update_query_job(query_job_id, status="Completed", result=result)
+
+    except Exception as e:
+        if query_jobs.is_query_job_cancelled(query_job_id):
+            return
+        frappe.log_error("Insights Query Job Failed")
+        query_jobs.update_query_job(query_job_id, status="Failed", error=str(e))
+
+    finally:
+        after_request()
+
+
+@insights_whitelist()
+def download_query_results(
+    operations, use_live_connection=True, file_format="csv", filename=None
+):
+    plan = get_query_plan(operations, use_live_connection)
+    if plan is None:
         return
 
-    results = execute_ibis_query(ibis_query, limit=100_00_00)
-    return results.to_csv(index=False)
+    record_plan_usage(plan)
+    path = export_query(plan.query, file_format)
+    filename = f"{frappe.scrub(filename or 'data')}.{file_format}"
+    return get_export_response(path, filename, file_format)
 
 
 @insights_whitelist()
 def get_distinct_column_values(
     operations, column_name, search_term=None, use_live_connection=True, limit=20
 ):
-    query = IbisQueryBuilder().build(operations, use_live_connection)
-    values_query = (
-        query.select(column_name)
-        .filter(
-            getattr(_, column_name).notnull()
-            if not search_term
-            else getattr(_, column_name).ilike(f"%{search_term}%")
+    plan = get_query_plan(operations, use_live_connection)
+    column = getattr(plan.query, column_name)
+
+    stats = get_source_column_stats(plan, column_name)
+    if stats and stats.get("top_values_complete"):
+        # all the values of the column were collected when the table was synced
+        return match_values(stats.top_values, search_term, limit)
+
+    def get_value_counts(max_values):
+        value_counts = (
+            plan.query.filter(column.notnull())
+            .group_by(column_name)
+            .aggregate(__value_count=_.count())
+            .order_by(ibis.desc("__value_count"))
+        )
+        return execute_ibis_query(value_counts, limit=max_values).values.tolist()
+
+    def search_source(search_term, limit):
+        values_query = (
+            plan.query.select(column_name)
+            .filter(column.ilike(f"%{search_term}%"))
+            .distinct()
+            .head(limit)
         )
-        .distinct()
-        .head(limit)
+        result = execute_ibis_query(values_query, cache=True)
+        return result[column_name].tolist()
+
+    freshness = plan.get_source_freshness()
+    return search_column_values(
+        key=(plan.sql, column_name, freshness),
+        get_value_counts=get_value_counts,
+        search_source=search_source,
+        search_term=search_term,
+        limit=limit,
+        # warehouse values are refreshed with the file, so they can be kept longer
+        expiry=COLUMN_VALUES_EXPIRY if freshness is None else WAREHOUSE_VALUES_EXPIRY,
     )
-    result = execute_ibis_query(values_query, cache=True)
-    return result[column_name].tolist()
 
 
 @insights_whitelist()
 def get_columns_for_selection(operations, use_live_connection=True):
-    query = IbisQueryBuilder().build(operations, use_live_connection)
-    columns = get_columns_from_schema(query.schema())
+    plan = get_query_plan(operations, use_live_connection)
+    columns = get_columns_from_schema(plan.schema)
     return columns
 
 
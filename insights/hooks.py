@@ -147,7 +147,10 @@ doc_events = {
 scheduler_events = {
     "all": [
         "insights.insights.doctype.insights_alert.insights_alert.send_alerts",
-    ]
+    ],
+    "hourly_long": [
+        "insights.insights.doctype.insights_data_source_v3.warehouse_sync.sync_stale_warehouse_tables",
+    ],
 }
 
 # Testing
@@ -9,11 +9,16 @@ from frappe.model.document import Document
 from frappe.utils.caching import redis_cache, site_cache
 
 from insights import notify
+from insights.insights.doctype.insights_data_source_v3.column_values import (
+    MAX_COLUMN_VALUES,
+    search_column_values,
+)
 from insights.insights.doctype.insights_query.insights_query import InsightsQuery
 from insights.insights.doctype.insights_team.insights_team import (
     check_table_permission,
     get_permission_filter,
 )
+from insights.utils import InsightsSettings
 
 from .sources.base_database import BaseDatabase, DatabaseConnectionError
 from .sources.frappe_db import FrappeDB, SiteDB, is_frappe_db
@@ -267,7 +272,20 @@ class InsightsDataSource(
         return self._db.get_table_columns(table)
 
     def get_column_options(self, table, column, search_text=None, limit=50):
-        return self._db.get_column_options(table, column, search_text, limit)
+        # results are capped by the query result limit, keep the values below it
+        max_results = InsightsSettings.get("query_result_limit") or 500
+        return search_column_values(
+            key=(self.name, table, column),
+            get_value_counts=lambda max_values: self._db.get_column_value_counts(
+                table, column, max_values
+            ),
+            search_source=lambda search_text, limit: self._db.get_column_options(
+                table, column, search_text, limit
+            ),
+            search_term=search_text,
+            limit=limit,
+            max_values=min(MAX_COLUMN_VALUES, max_results - 1),
+        )
 
     def get_table_preview(self, table, limit=100):
         return self._db.get_table_preview(table, limit)
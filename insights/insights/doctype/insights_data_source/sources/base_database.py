@@ -4,6 +4,9 @@
 import re
 
 import frappe
+from sqlalchemy import column as Column
+from sqlalchemy import func, select
+from sqlalchemy import table as Table
 from sqlalchemy.sql import text
 
 from insights.insights.doctype.insights_table_import.insights_table_import import (
@@ -58,6 +61,9 @@ class Database:
     def get_column_options(self):
         raise NotImplementedError
 
+    def get_column_value_counts(self):
+        raise NotImplementedError
+
     def get_table_preview(self):
         raise NotImplementedError
 
@@ -145,6 +151,19 @@ class BaseDatabase(Database):
             cached and cache_results(sql, self.data_source, ret)
             return ret
 
+    def get_column_value_counts(self, table, column, limit=50):
+        """Returns the distinct values of the column with their counts, most frequent first"""
+        value_count = func.count().label("value_count")
+        query = (
+            select(Column(column), value_count)
+            .select_from(Table(table))
+            .where(Column(column).is_not(None))
+            .group_by(Column(column))
+            .order_by(value_count.desc())
+            .limit(limit)
+        )
+        return self.execute_query(query)
+
     def compile_query(self, query):
         if hasattr(query, "compile"):
             compiled = compile_query(query, self.engine.dialect)
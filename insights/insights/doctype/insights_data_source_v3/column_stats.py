@@ -0,0 +1,97 @@
+import frappe
+import ibis
+from ibis.expr.operations.relations import DatabaseTable
+
+from .data_warehouse import get_table_sql
+
+# columns with more distinct values than this don't get their top values collected
+MAX_TOP_VALUES_NDV = 1000
+TOP_VALUES_LIMIT = 100
+TOP_VALUES_TYPES = ("VARCHAR", "BOOLEAN")
+
+
+def update_table_stats(data_source, table_name):
+    """Collects the statistics of the synced table and its columns.
+
+    Every column gets its type, null fraction, min, max, approximate number of
+    distinct values, and quartiles for numbers. Text columns with few distinct
+    values also get their most frequent values, so that filters can list them
+    without a query.
+    """
+    db = ibis.duckdb.connect()
+    try:
+        db.raw_sql(f"CREATE TEMP VIEW base AS {get_table_sql(data_source, table_name)}")
+        summary = db.raw_sql("SUMMARIZE base")
+        columns = [c[0] for c in summary.description]
+        rows = [frappe._dict(zip(columns, row)) for row in summary.fetchall()]
+
+        row_count = rows[0]["count"] if rows else 0
+        column_stats = {}
+        for row in rows:
+            stats = frappe._dict(
+                type=row.column_type,
+                null_fraction=float(row.null_percentage or 0) / 100,
+                min=row.min,
+                max=row.max,
+                ndv=row.approx_unique,
+            )
+            if row.q25 is not None:
+                stats.quartiles = [row.q25, row.q50, row.q75]
+            if (
+                row.column_type in TOP_VALUES_TYPES
+                and row.approx_unique <= MAX_TOP_VALUES_NDV
+            ):
+                stats.top_values, stats.top_values_complete = get_top_values(
+                    db, row.column_name
+                )
+            column_stats[row.column_name] = stats
+    finally:
+        db.disconnect()
+
+    frappe.db.set_value(
+        "Insights Table v3",
+        {"data_source": data_source, "table": table_name},
+        {"row_count": row_count, "column_stats": frappe.as_json(column_stats)},
+    )
+
+
+def get_top_values(db, column):
+    # one more than the limit is fetched to know if the values are complete
+    values = db.raw_sql(
+        f'SELECT "{column}" FROM base WHERE "{column}" IS NOT NULL '
+        f'GROUP BY "{column}" ORDER BY count(*) DESC LIMIT {TOP_VALUES_LIMIT + 1}'
+    ).fetchall()
+    values = [row[0] for row in values]
+    return values[:TOP_VALUES_LIMIT], len(values) <= TOP_VALUES_LIMIT
+
+
+def get_table_stats(data_source, table_name):
+    stats = frappe.db.get_value(
+        "Insights Table v3",
+        {"data_source": data_source, "table": table_name},
+        ["row_count", "column_stats"],
+        as_dict=True,
+        cache=True,
+    )
+    if not stats or not stats.column_stats:
+        return None
+    return frappe._dict(
+        row_count=stats.row_count,
+        columns=frappe.parse_json(stats.column_stats),
+    )
+
+
+def get_source_column_stats(plan, column_name):
+    """Returns the statistics of the column if the plan reads a synced table as is,
+    without filters or restrictions that change its values."""
+    if plan.use_live_connection or not isinstance(plan.query.op(), DatabaseTable):
+        return None
+    source = plan.tables.get(plan.query.op().name)
+    return get_column_stats(*source, column_name) if source else None
+
+
+def get_column_stats(data_source, table_name, column_name):
+    stats = get_table_stats(data_source, table_name)
+    if not stats or column_name not in stats.columns:
+        return None
+    return frappe._dict(stats.columns[column_name])
@@ -0,0 +1,64 @@
+import frappe
+
+from insights.cache_utils import get_or_set_cache, make_digest
+
+MAX_COLUMN_VALUES = 5000
+COLUMN_VALUES_EXPIRY = 60 * 10
+WAREHOUSE_VALUES_EXPIRY = 60 * 60 * 24
+
+
+def search_column_values(
+    key,
+    get_value_counts,
+    search_source,
+    search_term=None,
+    limit=20,
+    expiry=COLUMN_VALUES_EXPIRY,
+    max_values=MAX_COLUMN_VALUES,
+):
+    """Searches the distinct values of a column, most frequent values first.
+
+    The values are fetched once, ordered by their count, and cached so that typing
+    in a filter doesn't query the source on every keystroke. If the column has more
+    than `max_values` values, searches that don't find enough of the cached values
+    fall back to `search_source`.
+    """
+    values = get_or_set_cache(
+        f"column_values:{make_digest(key)}",
+        lambda: get_value_dictionary(get_value_counts, max_values),
+        expiry=expiry,
+    )
+
+    # not `values.values`, that is the method of the dict
+    matches = match_values(values["values"], search_term, limit)
+    if len(matches) < limit and not values.complete:
+        return search_source(search_term, limit)
+    return matches
+
+
+def get_value_dictionary(get_value_counts, max_values):
+    # one more than the max is fetched to know if the values are complete
+    value_counts = get_value_counts(max_values + 1)
+    return frappe._dict(
+        values=[row[0] for row in value_counts[:max_values]],
+        complete=len(value_counts) <= max_values,
+    )
+
+
+def match_values(values, search_term=None, limit=20):
+    if not search_term:
+        return values[:limit]
+
+    # values that start with the search term rank above the ones that contain it
+    search_term = search_term.lower()
+    prefix_matches, substring_matches = [], []
+    for value in values:
+        text = str(value).lower()
+        if text.startswith(search_term):
+            prefix_matches.append(value)
+            if len(prefix_matches) == limit:
+                break
+        elif search_term in text:
+            substring_matches.append(value)
+
+    return (prefix_matches + substring_matches)[:limit]
@@ -1,12 +1,30 @@
 import os
+import shutil
+import threading
+from contextlib import contextmanager
 
 import frappe
 import frappe.utils
 import ibis
 from frappe.utils import get_files_path
 from ibis import BaseBackend
+from ibis.expr.operations.relations import DatabaseTable
+
+from .warehouse_columns import (
+    get_placeholder_columns_sql,
+    get_sync_columns,
+    get_unsynced_column_types,
+)
+from .warehouse_extract import extract_to_parquet
 
 WAREHOUSE_DB_NAME = "insights.duckdb"
+WAREHOUSE_IMPORT_TIMEOUT = 60 * 60
+WAREHOUSE_VERSION_KEY = "insights:warehouse_version"
+QUERY_TABLE_PREFIX = "__insights_query_"
+# incremental syncs are merged into the table's file after these many syncs
+FRAGMENTS_TO_COMPACT = 20
+
+_local = threading.local()
 
 
 class DataWarehouse:
@@ -16,15 +34,34 @@ class DataWarehouse:
 
     @property
     def db(self) -> BaseBackend:
-        if not os.path.exists(self.db_path):
-            ddb = ibis.duckdb.connect(self.db_path)
-            ddb.disconnect()
+        return self.connection.db
+
+    @property
+    def connection(self):
+        """The warehouse connection of the thread, along with the tables registered
+        on it. It is kept open across requests, and the registered tables are
+        dropped from the catalog when any table is synced."""
+        connections = _local.__dict__.setdefault("connections", {})
+        connection = connections.get(self.db_path)
+        version = get_warehouse_version()
+
+        if not connection:
+            if not os.path.exists(self.db_path):
+                ddb = ibis.duckdb.connect(self.db_path)
+                ddb.disconnect()
+            connection = frappe._dict(
+                db=ibis.duckdb.connect(self.db_path, read_only=True),
+                version=version,
+                tables={},
+            )
+            connections[self.db_path] = connection
 
-        if WAREHOUSE_DB_NAME not in frappe.local.insights_db_connections:
-            ddb = ibis.duckdb.connect(self.db_path, read_only=True)
-            frappe.local.insights_db_connections[WAREHOUSE_DB_NAME] = ddb
+        elif connection.version != version:
+            # the views are replaced when the tables are registered again
+            connection.tables = {}
+            connection.version = version
 
-        return frappe.local.insights_db_connections[WAREHOUSE_DB_NAME]
+        return connection
 
     def get_table(self, data_source, table_name, use_live_connection=True):
         if use_live_connection:
@@ -33,28 +70,109 @@ class DataWarehouse:
             return self.get_warehouse_table(data_source, table_name)
 
     def get_warehouse_table(self, data_source, table_name, sync=True):
-        parquet_file = get_parquet_filepath(data_source, table_name)
         warehouse_table = get_warehouse_table_name(data_source, table_name)
+        connection = self.connection
+        if warehouse_table in connection.tables:
+            return DatabaseTable(
+                name=warehouse_table,
+                schema=connection.tables[warehouse_table],
+                source=connection.db,
+            ).to_expr()
 
+        parquet_file = get_parquet_filepath(data_source, table_name)
         if not os.path.exists(parquet_file):
             if sync:
-                self.import_remote_table(data_source, table_name)
-                return self.db.read_parquet(parquet_file, table_name=warehouse_table)
+                # the table is served from the source until the import is done
+                enqueue_warehouse_import(data_source, table_name)
+                return self.get_remote_table(data_source, table_name)
             else:
                 frappe.throw(
                     f"{table_name} of {data_source} is not synced to the data warehouse."
                 )
 
-        if not self.db.list_tables(warehouse_table):
+        table = self.register_warehouse_table(data_source, table_name)
+        connection.tables[warehouse_table] = table.schema()
+        return table
+
+    def register_warehouse_table(self, data_source, table_name):
+        parquet_file = get_parquet_filepath(data_source, table_name)
+        warehouse_table = get_warehouse_table_name(data_source, table_name)
+        placeholders = get_placeholder_columns_sql(data_source, table_name)
+        if (
+            os.path.isfile(parquet_file)
+            and not get_fragment_filepaths(data_source, table_name)
+            and not placeholders
+        ):
             return self.db.read_parquet(parquet_file, table_name=warehouse_table)
-        else:
-            return self.db.table(warehouse_table)
+
+        table_sql = get_table_sql(data_source, table_name)
+        if placeholders:
+            table_sql = f"SELECT *, {placeholders} FROM ({table_sql})"
+        self.db.raw_sql(
+            f'CREATE OR REPLACE TEMP VIEW "{warehouse_table}" AS {table_sql}'
+        )
+        return self.db.table(warehouse_table)
+
+    def get_rollup_table(self, data_source, table_name, rollup):
+        rollup_table = (
+            f"{get_warehouse_table_name(data_source, table_name)}.{rollup.name}"
+        )
+        connection = self.connection
+        if rollup_table not in connection.tables:
+            table = self.db.read_parquet(rollup.path, table_name=rollup_table)
+            connection.tables[rollup_table] = table.schema()
+        return DatabaseTable(
+            name=rollup_table,
+            schema=connection.tables[rollup_table],
+            source=connection.db,
+        ).to_expr()
+
+    def get_backend(self, data_source, table_name, use_live_connection=True):
+        if use_live_connection:
+            ds = frappe.get_doc("Insights Data Source v3", data_source)
+            return ds._get_ibis_backend()
+        # registers the parquet file with the warehouse if it isn't already
+        self.get_warehouse_table(data_source, table_name)
+        return self.db
 
     def get_remote_table(self, data_source, table_name):
         ds = frappe.get_doc("Insights Data Source v3", data_source)
         remote_db = ds._get_ibis_backend()
         return remote_db.table(table_name)
 
+    def sync_remote_table(self, data_source, table_name):
+        """Fetches the rows changed since the last sync if the table is synced
+        incrementally, otherwise imports the whole table again."""
+        with warehouse_table_lock(data_source, table_name):
+            settings = get_sync_settings(data_source, table_name)
+            path = get_parquet_filepath(data_source, table_name)
+            if (
+                settings.incremental_sync
+                and settings.watermark
+                and os.path.exists(path)
+            ):
+                self.import_changed_rows(data_source, table_name, settings)
+            else:
+                self.import_remote_table(data_source, table_name, force=True)
+            self.update_table_summaries(data_source, table_name)
+        # for the new fragment of an incremental sync, and the refreshed rollups
+        update_warehouse_version()
+
+    def update_table_summaries(self, data_source, table_name):
+        """Collects the statistics and builds the rollups of the table again,
+        both are built from the synced files so they are refreshed with them."""
+        from .column_stats import update_table_stats
+        from .warehouse_rollups import refresh_rollups
+
+        try:
+            update_table_stats(data_source, table_name)
+        except Exception:
+            frappe.log_error(f"Failed to collect statistics of {table_name}")
+        try:
+            refresh_rollups(data_source, table_name)
+        except Exception:
+            frappe.log_error(f"Failed to build the rollups of {table_name}")
+
     def import_remote_table(self, data_source, table_name, force=False):
         path = get_parquet_filepath(data_source, table_name)
         if os.path.exists(path) and not force:
@@ -68,14 +186,330 @@ class DataWarehouse:
         remote_db = ds._get_ibis_backend()
         table = remote_db.table(table_name)
 
-        if hasattr(table, "creation"):
-            max_records_to_sync = frappe.db.get_single_value(
-                "Insights Settings", "max_records_to_sync"
-            )
-            max_records_to_sync = max_records_to_sync or 10_00_000
+        settings = get_sync_settings(data_source, table_name)
+        columns = get_sync_columns(data_source, table_name, table, settings)
+        unsynced_columns = get_unsynced_column_types(table, columns)
+        table = table.select(columns)
+
+        # rows are streamed to the file, so the cap is optional
+        max_records_to_sync = frappe.db.get_single_value(
+            "Insights Settings", "max_records_to_sync"
+        )
+        if max_records_to_sync and hasattr(table, "creation"):
             table = table.order_by(ibis.desc("creation")).limit(max_records_to_sync)
 
-        table.to_parquet(path, compression="snappy")
+        download_path = f"{path}.download"
+        with ds._without_statement_timeout():
+            extract_to_parquet(table, download_path)
+        watermark = get_watermark(download_path, settings.watermark_column)
+        if settings.partition_by:
+            write_warehouse_files(
+                f"SELECT * FROM read_parquet('{quote_path(download_path)}')",
+                path,
+                settings,
+            )
+            os.remove(download_path)
+        else:
+            replace_path(download_path, path)
+
+        # a full import replaces the rows of the previous incremental syncs
+        for fragment in get_fragment_filepaths(data_source, table_name):
+            os.remove(fragment)
+        # the views of the other workers still read the removed files
+        update_warehouse_version()
+
+        update_sync_status(
+            data_source,
+            table_name,
+            watermark=watermark,
+            unsynced_columns=unsynced_columns,
+        )
+
+    def import_changed_rows(self, data_source, table_name, settings):
+        ds = frappe.get_doc("Insights Data Source v3", data_source)
+        remote_db = ds._get_ibis_backend()
+        table = remote_db.table(table_name)
+
+        unsynced_columns = frappe.parse_json(settings.unsynced_columns or "{}")
+        columns = get_sync_columns(data_source, table_name, table, settings)
+        if any(c in unsynced_columns for c in columns):
+            # columns used since the last import aren't in the table's files,
+            # the whole table is imported again to backfill them
+            return self.import_remote_table(data_source, table_name, force=True)
+        # the fragments have the same columns as the table's files
+        table = table.select([c for c in table.columns if c not in unsynced_columns])
+
+        column = settings.watermark_column
+        if column not in table.columns or settings.primary_key not in table.columns:
+            frappe.throw(
+                f"{table_name} of {data_source} doesn't have the {column} or "
+                f"{settings.primary_key} column needed for incremental sync."
+            )
+
+        # rows changed at the same time as the watermark may have been committed
+        # after the last sync, fetching them again is safe as rows are merged by key
+        watermark = ibis.literal(settings.watermark).cast(table[column].type())
+        changed_rows = table.filter(table[column] >= watermark)
+
+        fragments_path = get_fragments_folder_path(data_source, table_name)
+        os.makedirs(fragments_path, exist_ok=True)
+        fragment = os.path.join(
+            fragments_path, f"{frappe.utils.now_datetime():%Y%m%d%H%M%S%f}.parquet"
+        )
+        # fragments are read as soon as they are in the folder,
+        # so they are moved there only after they are written
+        with ds._without_statement_timeout():
+            extract_to_parquet(changed_rows, f"{fragment}.tmp")
+        os.replace(f"{fragment}.tmp", fragment)
+
+        update_sync_status(
+            data_source,
+            table_name,
+            watermark=get_watermark(fragment, column) or settings.watermark,
+        )
+
+        if len(get_fragment_filepaths(data_source, table_name)) >= FRAGMENTS_TO_COMPACT:
+            self.compact_warehouse_table(data_source, table_name)
+
+    def compact_warehouse_table(self, data_source, table_name):
+        """Merges the fragments of the incremental syncs into the table's files."""
+        fragments = get_fragment_filepaths(data_source, table_name)
+        if not fragments:
+            return
+
+        settings = get_sync_settings(data_source, table_name)
+        path = get_parquet_filepath(data_source, table_name)
+        write_warehouse_files(get_table_sql(data_source, table_name), path, settings)
+        for fragment in fragments:
+            os.remove(fragment)
+        update_warehouse_version()
+
+
+def enqueue_warehouse_import(data_source, table_name):
+    # requests for the same table reuse the job that is already queued or running
+    frappe.enqueue(
+        "insights.insights.doctype.insights_data_source_v3.data_warehouse.import_warehouse_table",
+        queue="long",
+        timeout=WAREHOUSE_IMPORT_TIMEOUT,
+        job_id=f"insights_warehouse_import::{data_source}::{table_name}",
+        deduplicate=True,
+        data_source=data_source,
+        table_name=table_name,
+    )
+
+
+def import_warehouse_table(data_source, table_name):
+    from .insights_data_source_v3 import after_request, before_request
+
+    # connections are set up per request, do the same for the job
+    before_request()
+    try:
+        with warehouse_table_lock(data_source, table_name):
+            # the table may have been imported while this job was waiting for the lock
+            if not is_warehouse_table_synced(data_source, table_name):
+                warehouse = DataWarehouse()
+                warehouse.import_remote_table(data_source, table_name)
+                # tables without a sync interval are only ever imported here
+                warehouse.update_table_summaries(data_source, table_name)
+                update_warehouse_version()
+    finally:
+        after_request()
+
+
+@contextmanager
+def warehouse_table_lock(data_source, table_name):
+    """Makes sure that a table is imported by only one process at a time,
+    across all the workers of the site."""
+    cache = frappe.cache()
+    lock = cache.lock(
+        cache.make_key(f"insights:warehouse_table_lock:{data_source}:{table_name}"),
+        timeout=WAREHOUSE_IMPORT_TIMEOUT,
+        blocking_timeout=WAREHOUSE_IMPORT_TIMEOUT,
+    )
+    if not lock.acquire():
+        frappe.throw(f"Timed out waiting for the sync of {table_name} of {data_source}")
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def get_warehouse_version():
+    return frappe.cache().get_value(WAREHOUSE_VERSION_KEY) or 0
+
+
+def update_warehouse_version():
+    # every worker registers the tables again on their next query
+    frappe.cache().set_value(WAREHOUSE_VERSION_KEY, frappe.generate_hash(length=10))
+
+
+def drop_query_tables():
+    """Drops the temporary tables of the queries built during the request,
+    as the warehouse connection outlives the request."""
+    for connection in getattr(_local, "connections", {}).values():
+        for table in connection.db.list_tables(like=QUERY_TABLE_PREFIX):
+            connection.db.drop_table(table, force=True)
+
+
+def is_warehouse_connection(backend: BaseBackend):
+    return any(c.db is backend for c in getattr(_local, "connections", {}).values())
+
+
+def get_warehouse_data_source(warehouse_table):
+    # data source names are already scrubbed, see `get_warehouse_table_name`
+    return warehouse_table.split(".", 1)[0]
+
+
+def is_warehouse_table_synced(data_source, table_name):
+    return os.path.exists(get_parquet_filepath(data_source, table_name))
+
+
+def get_sync_settings(data_source, table_name):
+    settings = frappe.db.get_value(
+        "Insights Table v3",
+        {"data_source": data_source, "table": table_name},
+        [
+            "incremental_sync",
+            "watermark_column",
+            "watermark",
+            "primary_key",
+            "partition_by",
+            "partition_column",
+            "sync_used_columns",
+            "include_columns",
+            "exclude_columns",
+            "unsynced_columns",
+        ],
+        as_dict=True,
+    )
+    settings = settings or frappe._dict()
+    settings.watermark_column = settings.watermark_column or "modified"
+    settings.primary_key = settings.primary_key or "name"
+    settings.partition_column = settings.partition_column or "creation"
+    return settings
+
+
+def update_sync_status(data_source, table_name, watermark=None, unsynced_columns=None):
+    values = {
+        "last_synced_on": frappe.utils.now(),
+        "watermark": frappe.utils.cstr(watermark) or None,
+    }
+    # incremental syncs keep the columns of the last import
+    if unsynced_columns is not None:
+        values["unsynced_columns"] = frappe.as_json(unsynced_columns)
+    frappe.db.set_value(
+        "Insights Table v3",
+        {"data_source": data_source, "table": table_name},
+        values,
+    )
+
+
+def get_watermark(path, column):
+    db = ibis.duckdb.connect()
+    try:
+        table = db.read_parquet(path)
+        if column not in table.columns:
+            return None
+        return table[column].max().execute()
+    finally:
+        db.disconnect()
+
+
+def get_table_sql(data_source, table_name):
+    """Returns the sql that reads the synced rows of the table from its files."""
+    path = get_parquet_filepath(data_source, table_name)
+    fragments = get_fragment_filepaths(data_source, table_name)
+
+    if os.path.isdir(path):
+        # the partition key is only a part of the file paths, not a column of the table
+        table_sql = (
+            "SELECT * EXCLUDE (__partition) FROM read_parquet("
+            f"'{quote_path(path)}/**/*.parquet', hive_partitioning = true)"
+        )
+    else:
+        table_sql = f"SELECT * FROM read_parquet('{quote_path(path)}')"
+
+    if not fragments:
+        return table_sql
+
+    # the last synced version of every row, fragments are named in the order they
+    # are synced. Rows are dropped by anti joins on the keys of the later fragments,
+    # so that filters on the table are still pushed down to its files
+    primary_key = get_sync_settings(data_source, table_name).primary_key
+    sources = [table_sql] + [
+        f"SELECT * FROM read_parquet('{quote_path(fragment)}')"
+        for fragment in fragments
+    ]
+    rows = []
+    for i, source in enumerate(sources):
+        later_fragments = fragments[i:]
+        if not later_fragments:
+            rows.append(source)
+            continue
+        files = ", ".join(f"'{quote_path(f)}'" for f in later_fragments)
+        rows.append(
+            f"SELECT * FROM ({source}) ANTI JOIN ("
+            f'SELECT "{primary_key}" FROM read_parquet([{files}], union_by_name = true)'
+            f') USING ("{primary_key}")'
+        )
+    return " UNION ALL BY NAME ".join(f"({row})" for row in rows)
+
+
+def write_warehouse_files(select_sql, path, settings):
+    """Writes the rows of the query to the table's path, in partitions if the table is
+    partitioned. Files are written to a temporary path first, so that the table is
+    never read while it is partially written."""
+    tmp_path = f"{path}.tmp"
+    remove_path(tmp_path)
+
+    options = "FORMAT PARQUET, COMPRESSION SNAPPY"
+    if settings.partition_by:
+        partition = get_partition_expression(settings)
+        select_sql = f"SELECT *, {partition} AS __partition FROM ({select_sql})"
+        options += ", PARTITION_BY (__partition)"
+
+    db = ibis.duckdb.connect()
+    try:
+        db.raw_sql(f"COPY ({select_sql}) TO '{quote_path(tmp_path)}' ({options})")
+    finally:
+        db.disconnect()
+
+    replace_path(tmp_path, path)
+
+
+def get_partition_expression(settings):
+    column = f'"{settings.partition_column}"'
+    if settings.partition_by == "Year":
+        return f"strftime({column}, '%Y')"
+    if settings.partition_by == "Month":
+        return f"strftime({column}, '%Y-%m')"
+    frappe.throw(f"Invalid partition type: {settings.partition_by}")
+
+
+def replace_path(src, dst):
+    if os.path.isfile(src) and not os.path.isdir(dst):
+        os.replace(src, dst)
+        return
+
+    # directories can't replace each other atomically,
+    # so the old one is moved aside for the shortest possible time
+    old_path = f"{dst}.old"
+    remove_path(old_path)
+    if os.path.exists(dst):
+        os.rename(dst, old_path)
+    os.rename(src, dst)
+    remove_path(old_path)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def quote_path(path):
+    return path.replace("'", "''")
 
 
 def get_warehouse_folder_path():
@@ -94,3 +528,30 @@ def get_parquet_filepath(data_source, table_name):
     warehouse_path = get_warehouse_folder_path()
     warehouse_table = get_warehouse_table_name(data_source, table_name)
     return os.path.join(warehouse_path, f"{warehouse_table}.parquet")
+
+
+def get_warehouse_freshness(tables):
+    """Returns the modified time of the warehouse files of the given tables."""
+    return [
+        [
+            os.path.getmtime(path)
+            for path in [
+                get_parquet_filepath(data_source, table_name),
+                *get_fragment_filepaths(data_source, table_name),
+            ]
+        ]
+        for data_source, table_name in sorted(set(tables))
+    ]
+
+
+def get_fragments_folder_path(data_source, table_name):
+    return get_parquet_filepath(data_source, table_name) + ".fragments"
+
+
+def get_fragment_filepaths(data_source, table_name):
+    path = get_fragments_folder_path(data_source, table_name)
+    if not os.path.exists(path):
+        return []
+    return sorted(
+        os.path.join(path, f) for f in os.listdir(path) if f.endswith(".parquet")
+    )
@@ -1,3 +1,5 @@
+from types import MappingProxyType
+
 import frappe
 import ibis
 from ibis import _
@@ -84,7 +86,20 @@ f_next_period_value = lambda column, date_column, offset=1: column.lead(offset).
 )
 
 
-def get_functions():
+# built once per process, see get_functions
+_functions: MappingProxyType | None = None
+_registered_functions = {}
+
+
+def get_functions() -> MappingProxyType:
+    """Returns a read-only mapping of the functions available in expressions."""
+    global _functions
+    if _functions is None:
+        _functions = MappingProxyType(build_functions())
+    return _functions
+
+
+def build_functions():
     context = frappe._dict()
 
     functions = globals()
@@ -98,10 +113,19 @@ def get_functions():
 
     context["s"] = selectors
     context["selectors"] = selectors
+    context.update(_registered_functions)
 
     return context
 
 
+def register_function(name: str, func):
+    """Makes a function available in expressions, e.g. from another app's hooks."""
+    global _functions
+    _registered_functions[name] = func
+    # rebuilt on the next use
+    _functions = None
+
+
 @frappe.whitelist()
 def get_function_list():
     return [key for key in get_functions() if not key.startswith("_")]
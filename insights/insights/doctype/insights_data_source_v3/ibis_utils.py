@@ -1,20 +1,37 @@
 import ast
 import time
+import unicodedata
+from functools import lru_cache
+from types import CodeType
 
 import frappe
+import frappe.utils
 import ibis
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from frappe.utils.data import flt
-from frappe.utils.safe_exec import safe_eval, safe_exec
+from frappe.utils.safe_exec import (
+    SERVER_SCRIPT_FILE_PREFIX,
+    WHITELISTED_SAFE_EVAL_GLOBALS,
+    FrappeTransformer,
+    ServerScriptNotEnabled,
+    _validate_safe_eval_syntax,
+    get_safe_globals,
+    is_safe_exec_enabled,
+    patched_qb,
+    safe_exec_flags,
+)
 from ibis import _
 from ibis import selectors as s
 from ibis.expr.datatypes import DataType
 from ibis.expr.operations.relations import DatabaseTable, Field
 from ibis.expr.types import Expr
 from ibis.expr.types import Table as IbisQuery
+from RestrictedPython import compile_restricted
 
-from insights.cache_utils import make_digest
+from insights.cache_utils import get_or_set_cache, make_digest
 from insights.insights.doctype.insights_table_v3.insights_table_v3 import (
     InsightsTablev3,
 )
@@ -22,23 +39,76 @@ from insights.insights.query_builders.sql_functions import handle_timespan
 from insights.utils import create_execution_log
 from insights.utils import deep_convert_dict_to_dict as _dict
 
+from .data_warehouse import QUERY_TABLE_PREFIX, DataWarehouse, get_warehouse_freshness
 from .ibis_functions import get_functions
+from .insights_data_source_v3 import interrupt_on_timeout
+from .warehouse_rollups import find_rollup, get_summary_shape, summarize_rollup
+
+TOTAL_COUNT_COLUMN = "__total_row_count"
+# results larger than this (after compression) are not cached
+MAX_CACHED_RESULT_SIZE = 10 * 1024 * 1024
+MAX_PIVOT_COLUMN_VALUES = 10
+PIVOT_COLUMN_NAMES_CACHE_EXPIRY = 60 * 10
+EXPRESSION_CACHE_SIZE = 1024
+UNORDERED_OPERATIONS = ("join", "union", "summarize", "pivot_wider", "custom_operation")
 
 
 class IbisQueryBuilder:
-    def build(self, operations: list, use_live_connection=True) -> IbisQuery:
+    def build(
+        self,
+        operations: list,
+        use_live_connection=True,
+        approximate=False,
+        sample_fraction=None,
+    ) -> IbisQuery:
+        if sample_fraction is not None and not 0 < sample_fraction <= 1:
+            frappe.throw("Sample fraction should be greater than 0 and at most 1")
+
         self.query = None
+        self.tables = {}
         self.use_live_connection = use_live_connection
+        # plans that use temporary tables can't be reused by other requests
+        self.cacheable = True
+        # approximate queries use approximate distinct counts,
+        # and only read a sample of the source table if a fraction is set
+        self.approximate = approximate
+        self.sample_fraction = sample_fraction if approximate else None
+        self.order_by = []
+        # columns that identify a row together, if they are known,
+        # pages of sorted results use them to break the ties of the sorts
+        self.unique_key = []
+        # shapes of the summaries of warehouse tables, counted on every execution
+        self.summary_shapes = []
+        self.set_schema()
         for operation in operations:
             self.query = self.perform_operation(operation)
+            self.set_schema()
+            if operation.get("type") in UNORDERED_OPERATIONS:
+                # the rows are no longer in the order of the previous sorts
+                self.order_by = []
         return self.query
 
+    def set_schema(self):
+        # the schema is kept along with the query after every operation,
+        # so that expressions don't have to derive the columns again
+        self.schema = self.query.schema() if self.query is not None else None
+        self._current_columns = None
+        if self.schema is not None:
+            # sorts on the columns that were removed can't be applied again
+            self.order_by = [key for key in self.order_by if key[0] in self.schema]
+            if not all(column in self.schema for column in self.unique_key):
+                self.unique_key = []
+
     def get_table(self, table):
-        return InsightsTablev3.get_ibis_table(
+        ibis_table = InsightsTablev3.get_ibis_table(
             table.data_source,
             table.table_name,
             use_live_connection=self.use_live_connection,
         )
+        # track the source of every table so that cached plans can be re-bound
+        for op in ibis_table.op().find(DatabaseTable):
+            self.tables[op.name] = (table.data_source, table.table_name)
+        return ibis_table
 
     def perform_operation(self, operation):
         operation = _dict(operation)
@@ -75,12 +145,20 @@ class IbisQueryBuilder:
         return self.query
 
     def apply_source(self, source_args):
-        return self.get_table(source_args.table)
+        table = self.get_table(source_args.table)
+        self.unique_key = get_unique_key(source_args.table, table)
+        if self.sample_fraction and self.sample_fraction < 1:
+            # only the source is sampled, sampling the joined tables as well
+            # would leave a fraction of a fraction of the matching rows
+            table = table.sample(self.sample_fraction)
+        return table
 
     def apply_join(self, join_args):
         right_table = self.get_right_table(join_args)
         join_condition = self.translate_join_condition(join_args, right_table)
         join_type = "outer" if join_args.join_type == "full" else join_args.join_type
+        # rows can match more than one row of the other table
+        self.unique_key = []
         return self.query.join(
             right_table,
             join_condition,
@@ -93,16 +171,65 @@ class IbisQueryBuilder:
         if table_args.type == "table":
             _table = self.get_table(table_args)
         if table_args.type == "query":
-            _table = IbisQueryBuilder().build(
-                table_args.operations,
-                use_live_connection=self.use_live_connection,
-            )
+            _table = self.get_query_table(table_args.operations)
 
         if _table is None:
             frappe.throw("Invalid join table")
 
         return _table
 
+    def get_query_table(self, operations):
+        # a query referenced more than once in a request is built only once,
+        # and in the warehouse, it is materialised when it is referenced again
+        memo = frappe.local.insights_query_memo
+        key = make_digest(
+            frappe.as_json(operations, indent=None),
+            self.use_live_connection,
+            self.approximate,
+        )
+        if key not in memo:
+            builder = IbisQueryBuilder()
+            query = builder.build(
+                operations,
+                use_live_connection=self.use_live_connection,
+                approximate=self.approximate,
+            )
+            memo[key] = frappe._dict(
+                query=query,
+                tables=builder.tables,
+                materialized=not builder.cacheable,
+                uses=0,
+            )
+
+        entry = memo[key]
+        entry.uses += 1
+        if entry.uses > 1 and not entry.materialized and not self.use_live_connection:
+            entry.table = self.materialize_query(key, entry)
+            entry.materialized = True
+
+        self.tables.update(entry.tables)
+        # temporary tables only live as long as the connection
+        self.cacheable = self.cacheable and not entry.materialized
+        return entry.table if entry.table is not None else entry.query
+
+    def materialize_query(self, key, entry) -> IbisQuery:
+        from .query_plan_cache import get_restrictions_fingerprint
+
+        # the name changes with the data and the restrictions,
+        # so cached results of queries using the table stay correct
+        tables = set(entry.tables.values())
+        name = QUERY_TABLE_PREFIX + make_digest(
+            key,
+            get_warehouse_freshness(tables),
+            get_restrictions_fingerprint(tables),
+        )
+        # the table is only created when a query that reads it is executed,
+        # so that building the query for its schema or sql doesn't run it
+        entry.table_name = name
+        return DatabaseTable(
+            name=name, schema=entry.query.schema(), source=DataWarehouse().db
+        ).to_expr()
+
     def get_right_table(self, join_args):
         right_table = self.get_table_or_query(join_args.table)
 
@@ -183,22 +310,24 @@ class IbisQueryBuilder:
 
         # Ensure both tables have the same columns
         # Add missing columns with None values
-        for col, dtype in self.query.schema().items():
-            if col not in other_table.columns:
+        other_schema = other_table.schema()
+        for col, dtype in self.schema.items():
+            if col not in other_schema:
                 other_table = other_table.mutate(
                     **{
                         col: ibis.literal(None).cast(dtype).name(col),
                     }
                 )
 
-        for col, dtype in other_table.schema().items():
-            if col not in self.query.columns:
+        for col, dtype in other_schema.items():
+            if col not in self.schema:
                 self.query = self.query.mutate(
                     **{
                         col: ibis.literal(None).cast(dtype).name(col),
                     }
                 )
 
+        self.unique_key = []
         return self.query.union(other_table, distinct=union_args.distinct)
 
     def apply_filter(self, filter_args):
@@ -270,6 +399,13 @@ class IbisQueryBuilder:
     def apply_rename(self, rename_args):
         old_name = rename_args.column.column_name
         new_name = frappe.scrub(rename_args.new_name)
+        self.order_by = [
+            (new_name if column == old_name else column, direction)
+            for column, direction in self.order_by
+        ]
+        self.unique_key = [
+            new_name if column == old_name else column for column in self.unique_key
+        ]
         return self.query.rename(**{new_name: old_name})
 
     def apply_remove(self, remove_args):
@@ -296,6 +432,8 @@ class IbisQueryBuilder:
         dtype = self.get_ibis_dtype(mutate_args.data_type)
         new_column = self.evaluate_expression(mutate_args.expression.expression)
         new_column = new_column.cast(dtype)
+        if new_name in self.unique_key:
+            self.unique_key = []
         return self.query.mutate(**{new_name: new_column})
 
     def apply_summary(self, summarize_args):
@@ -307,11 +445,52 @@ class IbisQueryBuilder:
             self.translate_dimension(dimension)
             for dimension in summarize_args.dimensions
         ]
-        return self.query.aggregate(**aggregates, by=group_bys)
+        summary = self.query.aggregate(**aggregates, by=group_bys)
+        # there is a row for every combination of the dimensions
+        self.unique_key = [c for c in summary.columns if c not in aggregates]
+        return self.get_rollup_summary(summarize_args, summary) or summary
+
+    def get_rollup_summary(self, summarize_args, summary) -> IbisQuery | None:
+        # only summaries of a whole warehouse table can be answered from a rollup,
+        # filters and restrictions change the rows that are aggregated
+        if self.use_live_connection or self.sample_fraction:
+            return None
+        if not isinstance(self.query.op(), DatabaseTable):
+            return None
+        # temporary tables of the reused queries aren't tracked as sources
+        source = self.tables.get(self.query.op().name)
+        if not source:
+            return None
+
+        shape = get_summary_shape(
+            *source, summarize_args.dimensions, summarize_args.measures
+        )
+        if not shape:
+            return None
+
+        self.summary_shapes.append(shape)
+        rollup = find_rollup(shape)
+        if not rollup:
+            return None
+
+        measures = {
+            frappe.scrub(measure.measure_name): measure
+            for measure in summarize_args.measures
+        }
+        rollup_table = DataWarehouse().get_rollup_table(*source, rollup)
+        # the rollup is registered by the build, binding a cached plan doesn't
+        self.cacheable = False
+        return summarize_rollup(rollup_table, measures, summary.schema())
 
     def apply_order_by(self, order_by_args):
-        order_fn = ibis.asc if order_by_args.direction == "asc" else ibis.desc
-        return self.query.order_by(order_fn(order_by_args.column.column_name))
+        column_name = order_by_args.column.column_name
+        direction = "asc" if order_by_args.direction == "asc" else "desc"
+        # ibis makes the latest sort the primary one, track them the same way
+        self.order_by = [(column_name, direction)] + [
+            key for key in self.order_by if key[0] != column_name
+        ]
+        order_fn = ibis.asc if direction == "asc" else ibis.desc
+        return self.query.order_by(order_fn(column_name))
 
     def apply_limit(self, limit_args):
         return self.query.limit(limit_args.limit)
@@ -331,27 +510,95 @@ class IbisQueryBuilder:
         }
 
         if pivot_type == "wider":
-            names = self.query.select(columns.keys()).distinct().limit(10).execute()
-            return (
-                self.query.group_by(*rows.values(), *columns.values())
-                .aggregate(**values)
-                .filter(
-                    ibis.or_(
-                        *[getattr(_, col).isin(names[col]) for col in columns.keys()]
-                    )
-                )
-                .pivot_wider(
-                    id_cols=rows.keys(),
-                    names_from=columns.keys(),
-                    names_sort=True,
-                    values_from=values.keys(),
-                    values_agg="sum",
+            aggregated = self.query.group_by(
+                *rows.values(), *columns.values()
+            ).aggregate(**values)
+            names = self.get_pivot_column_names(
+                aggregated,
+                list(columns.keys()),
+                list(values.keys()),
+                pivot_args.get("max_column_values") or MAX_PIVOT_COLUMN_VALUES,
+            )
+            if not names:
+                return aggregated.limit(0)
+
+            self.unique_key = list(rows.keys())
+
+            # ibis names the pivoted columns by joining the column values,
+            # so the pivot is on the text of the values
+            aggregated = aggregated.mutate(
+                **{col: aggregated[col].cast("string") for col in columns}
+            )
+            # passing the names stops ibis from running its own distinct query
+            return aggregated.filter(
+                ibis.or_(
+                    *[
+                        ibis.and_(
+                            *[
+                                getattr(_, col) == value
+                                for col, value in zip(columns.keys(), name)
+                            ]
+                        )
+                        for name in names
+                    ]
                 )
+            ).pivot_wider(
+                id_cols=rows.keys(),
+                names_from=columns.keys(),
+                names=names if len(columns) > 1 else [name[0] for name in names],
+                values_from=values.keys(),
+                values_agg="sum",
             )
 
         return self.query
 
+    def get_pivot_column_names(self, aggregated, columns, values, max_values):
+        """Returns the top column values of a pivot, ranked by the first measure,
+        as text and in the order of the values.
+
+        The values are cached, so that building the same pivot again
+        (for a count or a preview) doesn't query the source.
+        """
+        measure = getattr(aggregated, values[0])
+        rank = measure.sum() if measure.type().is_numeric() else measure.count()
+        name_columns = [f"__pivot_name_{i}" for i in range(len(columns))]
+        top_values = (
+            aggregated.group_by(*columns)
+            .aggregate(__pivot_rank=rank)
+            .order_by(ibis.desc("__pivot_rank"))
+            .limit(max_values)
+            .select(
+                *columns,
+                *[
+                    getattr(_, col).cast("string").name(name)
+                    for col, name in zip(columns, name_columns)
+                ],
+            )
+        )
+
+        def discover():
+            res = execute_ibis_query(top_values, limit=None, as_arrow=True)
+            values = zip(*[res[col].to_pylist() for col in columns])
+            names = zip(*[res[col].to_pylist() for col in name_columns])
+            # sorted by the values, so that numbers and dates keep their order
+            rows = sorted((v, n) for v, n in zip(values, names) if None not in v)
+            return [name for _, name in rows]
+
+        cache_key = make_digest(ibis.to_sql(top_values), self.get_source_freshness())
+        return get_or_set_cache(
+            f"pivot_column_names:{cache_key}",
+            discover,
+            expiry=PIVOT_COLUMN_NAMES_CACHE_EXPIRY,
+        )
+
+    def get_source_freshness(self):
+        # live tables can change at any time, only the cache expiry applies to them
+        if self.use_live_connection:
+            return None
+        return get_warehouse_freshness(self.tables.values())
+
     def apply_custom_operation(self, operation):
+        self.unique_key = []
         return self.evaluate_expression(
             operation.expression.expression,
             additonal_context={
@@ -361,7 +608,7 @@ class IbisQueryBuilder:
 
     def translate_measure(self, measure):
         if measure.column_name == "count" and measure.aggregation == "count":
-            return _.count()
+            return self.scale_to_population(_.count(), "count")
 
         if "expression" in measure:
             column = self.evaluate_expression(measure.expression.expression)
@@ -384,14 +631,25 @@ class IbisQueryBuilder:
         return col
 
     def apply_aggregate(self, column, aggregate_function):
-        return {
+        aggregate = {
             "sum": column.sum(),
             "avg": column.mean(),
             "count": column.count(),
             "min": column.min(),
             "max": column.max(),
-            "count_distinct": column.nunique(),
+            "count_distinct": (
+                column.approx_nunique() if self.approximate else column.nunique()
+            ),
         }[aggregate_function]
+        return self.scale_to_population(aggregate, aggregate_function)
+
+    def scale_to_population(self, aggregate, aggregate_function):
+        # counts and sums of a sample are scaled to estimate the full table's,
+        # the other aggregates are estimated as they are
+        if not self.sample_fraction or aggregate_function not in ("count", "sum"):
+            return aggregate
+        scaled = aggregate / self.sample_fraction
+        return scaled.round().cast("int64") if aggregate_function == "count" else scaled
 
     def apply_granularity(self, column, granularity):
         if granularity == "week":
@@ -433,39 +691,141 @@ class IbisQueryBuilder:
         if not expression or not expression.strip():
             raise ValueError(f"Invalid expression: {expression}")
 
-        context = frappe._dict()
-        context.q = _
-        context.update(self.get_current_columns())
-        context.update(get_functions())
-        context.update(additonal_context or {})
+        # eval needs a real dict as globals, so the prebuilt
+        # functions are copied over instead of being chained
+        context = {
+            "q": _,
+            **self.get_current_columns(),
+            **get_functions(),
+            **(additonal_context or {}),
+        }
 
         return exec_with_return(expression, context)
 
     def get_current_columns(self):
         # TODO: handle collisions with function names
-        return {col: getattr(_, col) for col in self.query.schema().names}
+        if self._current_columns is None:
+            self._current_columns = {col: getattr(_, col) for col in self.schema.names}
+        return self._current_columns
+
+
+def get_unique_key(table_args, table: IbisQuery) -> list:
+    # tables synced incrementally are merged on their primary key,
+    # and the tables of doctypes are keyed by name
+    settings = frappe.db.get_value(
+        "Insights Table v3",
+        {"data_source": table_args.data_source, "table": table_args.table_name},
+        ["incremental_sync", "primary_key"],
+        as_dict=True,
+        cache=True,
+    )
+    if settings and settings.incremental_sync and settings.primary_key:
+        primary_key = settings.primary_key
+    elif table_args.table_name.startswith("tab") and frappe.db.get_value(
+        "Insights Data Source v3", table_args.data_source, "is_frappe_db", cache=True
+    ):
+        primary_key = "name"
+    else:
+        return []
+    return [primary_key] if primary_key in table.columns else []
 
 
 def execute_ibis_query(
-    query: IbisQuery, query_name=None, limit=100, cache=False, cache_expiry=3600
-) -> pd.DataFrame:
+    query: IbisQuery,
+    query_name=None,
+    limit=100,
+    cache=False,
+    cache_expiry=3600,
+    as_arrow=False,
+) -> pd.DataFrame | pa.Table:
     query = query.head(limit) if limit else query
     sql = ibis.to_sql(query)
 
-    if cache and has_cached_results(sql):
-        return get_cached_results(sql)
-
-    start = time.monotonic()
-    res: pd.DataFrame = query.execute()
-    create_execution_log(sql, flt(time.monotonic() - start, 3), query_name)
-
-    res = res.replace({pd.NaT: None, np.nan: None})
-
-    if cache:
-        # TODO: fix: pivot queries are not same, so cache key is always different
-        cache_results(sql, res, cache_expiry)
-
-    return res
+    res = get_cached_results(sql) if cache else None
+    if res is None:
+        create_query_tables(query)
+        start = time.monotonic()
+        with interrupt_on_timeout(query):
+            res: pa.Table = query.to_pyarrow()
+        time_taken = flt(time.monotonic() - start, 3)
+        create_execution_log(sql, time_taken, query_name)
+
+        if cache:
+            cache_results(sql, res, cache_expiry, time_taken)
+
+    return res if as_arrow else to_dataframe(res)
+
+
+def create_query_tables(query: IbisQuery):
+    """Creates the temporary tables of the reused queries that the query reads."""
+    memo = getattr(frappe.local, "insights_query_memo", {})
+    entries = {entry.table_name: entry for entry in memo.values() if entry.table_name}
+    for op in query.op().find(DatabaseTable):
+        entry = entries.get(op.name)
+        if not entry or op.source.list_tables(like=op.name):
+            continue
+        # the reused query can read the tables of other reused queries
+        create_query_tables(entry.query)
+        op.source.create_table(op.name, obj=entry.query, temp=True)
+
+
+def execute_ibis_query_with_count(
+    query: IbisQuery,
+    query_name=None,
+    limit=100,
+    cache=False,
+    cache_expiry=3600,
+    as_arrow=False,
+    order_by: list | None = None,
+) -> tuple[pd.DataFrame | pa.Table, int]:
+    # the window is evaluated before the limit is applied,
+    # so every row carries the count of the full result set
+    query = query.mutate(**{TOTAL_COUNT_COLUMN: _.count().over()})
+    if order_by:
+        # the sorted query becomes a subquery of the window, and mariadb ignores
+        # the order of subqueries without a limit, so the sort is applied again
+        query = query.order_by(order_by)
+    res = execute_ibis_query(query, query_name, limit, cache, cache_expiry, as_arrow)
+
+    if as_arrow:
+        total_count = res[TOTAL_COUNT_COLUMN][0].as_py() if res.num_rows else 0
+        columns = [col for col in res.column_names if col != TOTAL_COUNT_COLUMN]
+        return res.select(columns), int(total_count)
+
+    total_count = int(res[TOTAL_COUNT_COLUMN].iloc[0]) if len(res) else 0
+    res = res.drop(columns=[TOTAL_COUNT_COLUMN])
+    return res, total_count
+
+
+def to_dataframe(table: pa.Table) -> pd.DataFrame:
+    return table.to_pandas().replace({pd.NaT: None, np.nan: None})
+
+
+def to_columnar(table: pa.Table) -> list[list]:
+    # one list of values per column, avoids repeating column names for every row
+    data = []
+    for column in table.columns:
+        if pa.types.is_floating(column.type):
+            column = pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column)
+        data.append(column.to_pylist())
+    return data
+
+
+def to_arrow_ipc(
+    table: pa.Table, metadata: dict | None = None, compression=None
+) -> bytes:
+    if metadata:
+        table = table.replace_schema_metadata({"insights": frappe.as_json(metadata)})
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def from_arrow_ipc(data: bytes) -> pa.Table:
+    with pa.ipc.open_stream(data) as reader:
+        return reader.read_all()
 
 
 def get_columns_from_schema(schema: ibis.Schema):
@@ -500,29 +860,36 @@ def to_insights_type(dtype: DataType):
     frappe.throw(f"Cannot infer data type for: {dtype}")
 
 
-def cache_results(sql, result: pd.DataFrame, cache_expiry=3600):
-    cache_key = make_digest(sql)
-    cache_key = "insights:query_results:" + cache_key
-    data = result.to_dict(orient="records")
-    data = frappe.as_json(data)
-    frappe.cache().set_value(cache_key, data, expires_in_sec=cache_expiry)
-
+def cache_results(sql, result: pa.Table, cache_expiry=3600, time_taken=None):
+    data = to_arrow_ipc(result, compression="zstd")
+    if len(data) > MAX_CACHED_RESULT_SIZE:
+        return
 
-def get_cached_results(sql) -> pd.DataFrame:
-    cache_key = make_digest(sql)
-    cache_key = "insights:query_results:" + cache_key
-    data = frappe.cache().get_value(cache_key)
-    if not data:
+    cache_key = get_results_cache_key(sql)
+    frappe.cache().set_value(
+        cache_key,
+        {
+            "data": data,
+            "schema": {field.name: str(field.type) for field in result.schema},
+            "row_count": result.num_rows,
+            "size": len(data),
+            "time_taken": time_taken,
+            "cached_on": frappe.utils.now(),
+        },
+        expires_in_sec=cache_expiry,
+    )
+
+
+def get_cached_results(sql) -> pa.Table | None:
+    cache_key = get_results_cache_key(sql)
+    cached = frappe.cache().get_value(cache_key)
+    if not cached:
         return None
-    data = frappe.parse_json(data)
-    df = pd.DataFrame(data).replace({pd.NaT: None, np.nan: None})
-    return df
+    return from_arrow_ipc(cached["data"])
 
 
-def has_cached_results(sql):
-    cache_key = make_digest(sql)
-    cache_key = "insights:query_results:" + cache_key
-    return frappe.cache().get_value(cache_key) is not None
+def get_results_cache_key(sql):
+    return "insights:query_results:" + make_digest(sql)
 
 
 def exec_with_return(
@@ -530,6 +897,18 @@ def exec_with_return(
     _globals: dict | None = None,
     _locals: dict | None = None,
 ):
+    statements, last_expression = split_code(code)
+
+    _globals = _globals or {}
+    _locals = _locals or {}
+    if statements:
+        cached_safe_exec(statements, _globals, _locals)
+    return cached_safe_eval(last_expression or code, _globals, _locals)
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def split_code(code: str) -> tuple[str | None, str | None]:
+    """Splits the code into the statements to execute and the expression to return."""
     a = ast.parse(code)
 
     last_expression = None
@@ -541,10 +920,44 @@ def exec_with_return(
         elif isinstance(a_last, ast.AnnAssign | ast.AugAssign):
             last_expression = ast.unparse(a_last.target)
 
-    _globals = _globals or {}
-    _locals = _locals or {}
-    if last_expression:
-        safe_exec(ast.unparse(a), _globals, _locals)
-        return safe_eval(last_expression, _globals, _locals)
-    else:
-        return safe_eval(code, _globals, _locals)
+    if not last_expression:
+        return None, None
+    return (ast.unparse(a) if a.body else None), last_expression
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_safe_eval(expression: str) -> CodeType:
+    # same validation and compilation as frappe's safe_eval
+    expression = unicodedata.normalize("NFKC", expression)
+    _validate_safe_eval_syntax(expression)
+    # raises on expressions that the policy doesn't allow
+    return compile_restricted(
+        expression, filename="<safe_eval>", policy=FrappeTransformer, mode="eval"
+    )
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_safe_exec(script: str) -> CodeType:
+    # same compilation as frappe's safe_exec
+    return compile_restricted(
+        script, filename=SERVER_SCRIPT_FILE_PREFIX, policy=FrappeTransformer
+    )
+
+
+def cached_safe_exec(script: str, _globals: dict, _locals: dict):
+    # same checks and globals as frappe's safe_exec, only the compiled code is reused
+    if not is_safe_exec_enabled():
+        frappe.throw("Server Scripts are disabled", ServerScriptNotEnabled)
+
+    code = compile_safe_exec(script)
+    exec_globals = get_safe_globals()
+    exec_globals.update(_globals)
+    with safe_exec_flags(), patched_qb():
+        exec(code, exec_globals, _locals)
+
+
+def cached_safe_eval(expression: str, _globals: dict, _locals: dict | None = None):
+    code = compile_safe_eval(expression)
+    _globals["__builtins__"] = {}
+    _globals.update(WHITELISTED_SAFE_EVAL_GLOBALS)
+    return eval(code, _globals, _locals)
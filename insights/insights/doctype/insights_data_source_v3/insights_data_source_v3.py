@@ -3,14 +3,25 @@
 
 
 import re
+import threading
+from contextlib import contextmanager
 
 import frappe
+import frappe.utils
 import ibis
 from frappe.model.document import Document
 from ibis import BaseBackend
+from ibis.expr.operations.relations import DatabaseTable
+from ibis.expr.types import Table as IbisQuery
 
 from insights.insights.doctype.insights_data_source_v3.data_warehouse import (
     WAREHOUSE_DB_NAME,
+    drop_query_tables,
+    get_warehouse_data_source,
+    is_warehouse_connection,
+)
+from insights.insights.doctype.insights_data_source_v3.query_plan_cache import (
+    clear_query_plan_cache,
 )
 from insights.insights.doctype.insights_table_link_v3.insights_table_link_v3 import (
     InsightsTableLinkv3,
@@ -64,6 +75,9 @@ class InsightsDataSourceDocument:
         if self.status == "Active" and credentials_changed:
             self.update_table_list()
 
+        if credentials_changed:
+            clear_query_plan_cache()
+
     def has_credentials_changed(self):
         doc_before = self.get_doc_before_save()
         if not doc_before:
@@ -130,7 +144,9 @@ class InsightsDataSourcev3(InsightsDataSourceDocument, Document):
         is_site_db: DF.Check
         password: DF.Password | None
         port: DF.Int
+        statement_timeout: DF.Int
         status: DF.Literal["Inactive", "Active"]
+        sync_interval: DF.Int
         title: DF.Data
         use_ssl: DF.Check
         username: DF.Data | None
@@ -148,9 +164,65 @@ class InsightsDataSourcev3(InsightsDataSourceDocument, Document):
             db.raw_sql("SET SESSION time_zone='+00:00'")
             db.raw_sql("SET collation_connection = 'utf8mb4_unicode_ci'")
 
+        self._set_statement_timeout(db)
+
         frappe.local.insights_db_connections[self.name] = db
         return db
 
+    def _set_statement_timeout(self, db: BaseBackend, timeout=None):
+        # duckdb & sqlite queries are interrupted on timeout, see `interrupt_on_timeout`
+        if timeout is None:
+            timeout = frappe.utils.cint(self.statement_timeout)
+            if not timeout:
+                return
+        if self.database_type == "MariaDB":
+            db.raw_sql(f"SET SESSION max_statement_time = {timeout}")
+        if self.database_type == "PostgreSQL":
+            db.raw_sql(f"SET statement_timeout = {timeout * 1000}")
+
+    @contextmanager
+    def _without_statement_timeout(self):
+        """Lifts the statement timeout of the connection while a table is synced,
+        as the whole table is read by a single statement."""
+        db = self._get_ibis_backend()
+        if not frappe.utils.cint(self.statement_timeout):
+            yield db
+            return
+
+        self._set_statement_timeout(db, 0)
+        try:
+            yield db
+        finally:
+            # the connection is used by the other queries of the request
+            catch_error(lambda: self._set_statement_timeout(db))
+
+    def _get_process_id(self):
+        # id of the connection on the database server, used to kill running queries
+        if self.database_type == "MariaDB":
+            sql = "SELECT CONNECTION_ID()"
+        elif self.database_type == "PostgreSQL":
+            sql = "SELECT pg_backend_pid()"
+        else:
+            return None
+
+        db = self._get_ibis_backend()
+        return db.raw_sql(sql).fetchall()[0][0]
+
+    def _kill_query(self, process_id):
+        if self.database_type == "MariaDB":
+            sql = f"KILL QUERY {frappe.utils.cint(process_id)}"
+        elif self.database_type == "PostgreSQL":
+            sql = f"SELECT pg_cancel_backend({frappe.utils.cint(process_id)})"
+        else:
+            return
+
+        # the connection running the query is busy, so use a new one
+        db: BaseBackend = ibis.connect(self._get_connection_string())
+        try:
+            db.raw_sql(sql)
+        finally:
+            catch_error(db.disconnect)
+
     def _get_connection_string(self):
         if self.is_site_db:
             return get_sitedb_connection_string()
@@ -183,6 +255,9 @@ class InsightsDataSourcev3(InsightsDataSourceDocument, Document):
         remote_db = self._get_ibis_backend()
         tables = remote_db.list_tables()
         tables = [t for t in tables if not blacklisted(t)]
+        # the columns of the tables may have changed as well,
+        # and cached plans keep the schemas they were built with
+        clear_query_plan_cache()
 
         if force:
             frappe.db.delete(
@@ -224,11 +299,65 @@ class InsightsDataSourcev3(InsightsDataSourceDocument, Document):
 def before_request():
     if not hasattr(frappe.local, "insights_db_connections"):
         frappe.local.insights_db_connections = {}
+    # queries referenced by other queries, built once per request
+    if not hasattr(frappe.local, "insights_query_memo"):
+        frappe.local.insights_query_memo = {}
 
 
 def after_request():
     for db in frappe.local.insights_db_connections.values():
         catch_error(db.disconnect)
+    # the warehouse connection is kept open, only the query tables are dropped
+    catch_error(drop_query_tables)
+    # the built queries are bound to the connections closed above
+    frappe.local.insights_query_memo = {}
+
+
+def get_statement_timeout(backend: BaseBackend, query: IbisQuery):
+    if is_warehouse_connection(backend):
+        # warehouse queries get the shortest timeout of the data sources they read
+        data_sources = {
+            get_warehouse_data_source(op.name) for op in query.op().find(DatabaseTable)
+        }
+        if not data_sources:
+            return None
+        timeouts = frappe.get_all(
+            "Insights Data Source v3",
+            filters={
+                "name": ["in", list(data_sources)],
+                "statement_timeout": [">", 0],
+            },
+            pluck="statement_timeout",
+        )
+        return min(timeouts, default=None)
+
+    connections = getattr(frappe.local, "insights_db_connections", {})
+    for name, db in connections.items():
+        if db is backend and name != WAREHOUSE_DB_NAME:
+            return frappe.db.get_value(
+                "Insights Data Source v3", name, "statement_timeout", cache=True
+            )
+
+
+@contextmanager
+def interrupt_on_timeout(query: IbisQuery):
+    # duckdb & sqlite (and so the warehouse) don't have a statement timeout setting,
+    # so the query is interrupted from another thread instead
+    backend = query._find_backend(use_default=True)
+    timeout = None
+    if backend.name in ("duckdb", "sqlite"):
+        timeout = frappe.utils.cint(get_statement_timeout(backend, query))
+
+    if not timeout:
+        yield
+        return
+
+    timer = threading.Timer(timeout, backend.con.interrupt)
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
 
 
 def catch_error(fn):
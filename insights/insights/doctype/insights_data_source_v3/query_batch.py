@@ -0,0 +1,116 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from typing import Callable
+
+import frappe
+
+from insights.cache_utils import make_digest
+
+from .insights_data_source_v3 import after_request, before_request
+from .query_plan_cache import QueryPlan, get_query_plan, get_referenced_tables
+
+BATCH_MAX_WORKERS = 4
+MAX_CONCURRENT_QUERIES_PER_SOURCE = 2
+MAX_BATCH_SIZE = 50
+WAREHOUSE_SOURCE = "__warehouse"
+
+
+def run_query_batch(
+    queries: list[dict],
+    execute: Callable[[QueryPlan], dict],
+    on_result: Callable[[list[str], dict], None] | None = None,
+) -> dict:
+    """Runs the queries concurrently and returns their results by query name.
+
+    Each query is a dict of name, operations, use_live_connection and approximate.
+    Identical queries are run once, and a data source runs at most
+    MAX_CONCURRENT_QUERIES_PER_SOURCE queries at a time. `on_result` is called
+    with the names and the result of each query as soon as it completes.
+    """
+    if len(queries) > MAX_BATCH_SIZE:
+        frappe.throw(f"A batch can have at most {MAX_BATCH_SIZE} queries")
+
+    names_by_key = {}
+    unique_queries = {}
+    for query in queries:
+        query = frappe._dict(query)
+        key = get_batch_query_key(query)
+        names_by_key.setdefault(key, []).append(query.name)
+        unique_queries.setdefault(key, query)
+
+    semaphores = {}
+    for query in unique_queries.values():
+        for source in get_query_sources(query):
+            semaphores.setdefault(
+                source, threading.BoundedSemaphore(MAX_CONCURRENT_QUERIES_PER_SOURCE)
+            )
+
+    context = frappe._dict(
+        site=frappe.local.site,
+        sites_path=frappe.local.sites_path,
+        user=frappe.session.user,
+    )
+
+    results = {}
+    max_workers = min(BATCH_MAX_WORKERS, len(unique_queries)) or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                run_batch_query,
+                context,
+                query,
+                [semaphores[source] for source in get_query_sources(query)],
+                execute,
+            ): key
+            for key, query in unique_queries.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            result = future.result()
+            for name in names_by_key[key]:
+                results[name] = result
+            if on_result:
+                on_result(names_by_key[key], result)
+
+    return results
+
+
+def run_batch_query(context, query, semaphores, execute):
+    # every thread needs its own site context and connections
+    frappe.init(site=context.site, sites_path=context.sites_path)
+    frappe.connect()
+    frappe.set_user(context.user)
+    before_request()
+    try:
+        with ExitStack() as stack:
+            for semaphore in semaphores:
+                stack.enter_context(semaphore)
+            plan = get_query_plan(
+                query.operations,
+                query.get("use_live_connection", True),
+                query.get("approximate", False),
+            )
+            return execute(plan) if plan else None
+    except Exception as e:
+        frappe.log_error("Error running a batch query")
+        return {"error": frappe.as_unicode(e)}
+    finally:
+        after_request()
+        frappe.destroy()
+
+
+def get_query_sources(query):
+    # sorted, so that the semaphores are always acquired in the same order
+    if not query.get("use_live_connection", True):
+        return [WAREHOUSE_SOURCE]
+    tables = get_referenced_tables(query.operations)
+    return sorted({data_source for data_source, _ in tables})
+
+
+def get_batch_query_key(query):
+    return make_digest(
+        frappe.as_json(query.operations, indent=None),
+        bool(query.get("use_live_connection", True)),
+        bool(query.get("approximate", False)),
+    )
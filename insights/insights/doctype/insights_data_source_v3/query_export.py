@@ -0,0 +1,146 @@
+import datetime
+import os
+import tempfile
+from contextlib import contextmanager
+
+import frappe
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from ibis.expr.types import Table as IbisQuery
+from werkzeug.wrappers import Response
+
+from insights.utils import InsightsSettings
+
+from .ibis_utils import create_query_tables
+
+EXPORT_BATCH_SIZE = 50_000
+EXPORT_CHUNK_SIZE = 1024 * 1024
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def export_query(query: IbisQuery, file_format="csv"):
+    """Writes the results of the query to a temporary file and returns its path.
+
+    Rows are written batch by batch, so memory usage doesn't grow with the size
+    of the result, and the size limit is checked while the file is written.
+    Warehouse queries are streamed from duckdb the same way.
+    """
+    if file_format not in EXPORT_FORMATS:
+        frappe.throw(f"Unsupported export format: {file_format}")
+
+    max_rows, max_size = get_export_limits()
+    query = query.head(max_rows)
+    create_query_tables(query)
+
+    fd, path = tempfile.mkstemp(prefix="insights_export_", suffix=f".{file_format}")
+    os.close(fd)
+
+    try:
+        write_batches(query, path, file_format, max_size)
+        check_export_size(path, max_size)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path
+
+
+def get_export_limits():
+    max_rows = InsightsSettings.get("max_export_rows") or 100_00_00
+    max_size = InsightsSettings.get("max_export_size") or 500
+    return max_rows, max_size * 1024 * 1024
+
+
+def write_batches(query: IbisQuery, path, file_format, max_size):
+    reader = query.to_pyarrow_batches(chunk_size=EXPORT_BATCH_SIZE)
+    rows_written = 0
+    bytes_written = 0
+    with open_batch_writer(path, file_format, reader.schema) as write_batch:
+        for batch in reader:
+            write_batch(batch)
+            rows_written += batch.num_rows
+            bytes_written += batch.nbytes
+            if file_format == "xlsx":
+                # xlsx files are only written when the workbook is saved, so the
+                # size of the rows is checked instead, the saved file is usually smaller
+                check_size(bytes_written, max_size)
+            else:
+                check_export_size(path, max_size)
+            publish_export_progress(rows_written)
+
+
+@contextmanager
+def open_batch_writer(path, file_format, schema: pa.Schema):
+    if file_format == "csv":
+        with pa_csv.CSVWriter(path, schema) as writer:
+            yield writer.write_batch
+
+    elif file_format == "parquet":
+        with pq.ParquetWriter(path, schema, compression="snappy") as writer:
+            yield lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+
+    elif file_format == "xlsx":
+        from openpyxl import Workbook
+
+        # write only workbooks stream the rows to a temporary file
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(schema.names)
+
+        def write_batch(batch: pa.RecordBatch):
+            columns = [column.to_pylist() for column in batch.columns]
+            for row in zip(*columns):
+                sheet.append([to_excel_value(value) for value in row])
+
+        yield write_batch
+        workbook.save(path)
+
+
+def to_excel_value(value):
+    # excel doesn't support timezone aware datetimes
+    if isinstance(value, datetime.datetime) and value.tzinfo:
+        return value.replace(tzinfo=None)
+    return value
+
+
+def check_export_size(path, max_size):
+    check_size(os.path.getsize(path), max_size)
+
+
+def check_size(size, max_size):
+    if size > max_size:
+        frappe.throw(
+            f"Export is larger than {max_size // (1024 * 1024)} MB. "
+            "Please add filters or remove columns to reduce the size."
+        )
+
+
+def publish_export_progress(rows_written):
+    frappe.publish_realtime(
+        event="insights_export_progress",
+        user=frappe.session.user,
+        message={"rows_written": rows_written},
+    )
+
+
+def get_export_response(path, filename, file_format) -> Response:
+    def stream_file():
+        with open(path, "rb") as f:
+            while chunk := f.read(EXPORT_CHUNK_SIZE):
+                yield chunk
+
+    response = Response(
+        stream_file(),
+        mimetype=EXPORT_FORMATS[file_format],
+        direct_passthrough=True,
+    )
+    response.headers["Content-Length"] = str(os.path.getsize(path))
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    # remove the file even if the client disconnects before the download starts
+    response.call_on_close(lambda: os.path.exists(path) and os.remove(path))
+    return response
@@ -0,0 +1,117 @@
+import frappe
+import frappe.utils
+from frappe.utils.background_jobs import get_job
+
+QUERY_JOB_KEY_PREFIX = "insights:query_job:"
+QUERY_JOB_EXPIRY = 60 * 60
+QUERY_JOB_TIMEOUT = 30 * 60
+
+
+def create_query_job():
+    job_id = frappe.generate_hash(length=16)
+    save_query_job(
+        frappe._dict(
+            job_id=job_id,
+            owner=frappe.session.user,
+            status="Queued",
+            result=None,
+            error=None,
+            created_on=frappe.utils.now(),
+        )
+    )
+    return job_id
+
+
+def get_query_job(job_id, check_owner=True):
+    # skip the request local cache, the job is updated by another process
+    job = frappe.cache().get_value(get_query_job_key(job_id), expires=True)
+    if not job:
+        frappe.throw(f"Query job {job_id} not found or has expired")
+
+    job = frappe._dict(job)
+    if check_owner and job.owner != frappe.session.user:
+        frappe.throw(
+            "You do not have permission to access this query job",
+            exc=frappe.PermissionError,
+        )
+    return job
+
+
+def update_query_job(job_id, **kwargs):
+    job = get_query_job(job_id, check_owner=False)
+    job.update(kwargs)
+    save_query_job(job)
+    frappe.publish_realtime(
+        event="insights_query_job",
+        user=job.owner,
+        message=job,
+    )
+    return job
+
+
+def save_query_job(job):
+    frappe.cache().set_value(
+        get_query_job_key(job.job_id),
+        job,
+        expires_in_sec=QUERY_JOB_EXPIRY,
+    )
+
+
+def is_query_job_cancelled(job_id):
+    return get_query_job(job_id, check_owner=False).status == "Cancelled"
+
+
+def cancel_query_job(job_id):
+    job = get_query_job(job_id)
+    if job.status not in ("Queued", "Running"):
+        return job
+
+    job = update_query_job(job_id, status="Cancelled")
+    # kill the queries first, stopping the job doesn't stop them on the server
+    kill_query_job_processes(job)
+    stop_rq_job(job_id)
+    return job
+
+
+def set_query_job_processes(job_id, plan):
+    if not plan.use_live_connection:
+        return
+
+    processes = []
+    for data_source in {data_source for data_source, _ in plan.tables.values()}:
+        ds = frappe.get_doc("Insights Data Source v3", data_source)
+        process_id = ds._get_process_id()
+        if process_id:
+            processes.append({"data_source": data_source, "process_id": process_id})
+
+    update_query_job(job_id, processes=processes)
+
+
+def kill_query_job_processes(job):
+    for process in job.get("processes") or []:
+        try:
+            ds = frappe.get_doc("Insights Data Source v3", process["data_source"])
+            ds._kill_query(process["process_id"])
+        except Exception:
+            frappe.log_error("Failed to kill query of a cancelled query job")
+
+
+def stop_rq_job(job_id):
+    from rq.command import send_stop_job_command
+
+    rq_job = get_job(get_rq_job_id(job_id))
+    if not rq_job:
+        return
+
+    if rq_job.get_status() == "started":
+        send_stop_job_command(rq_job.connection, rq_job.id)
+    else:
+        rq_job.cancel()
+
+
+def get_rq_job_id(job_id):
+    return f"insights_query_job::{job_id}"
+
+
+def get_query_job_key(job_id):
+    return QUERY_JOB_KEY_PREFIX + job_id
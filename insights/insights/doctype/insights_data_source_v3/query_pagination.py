@@ -0,0 +1,179 @@
+import frappe
+import ibis
+import pyarrow as pa
+from ibis.expr.types import Table as IbisQuery
+
+from .ibis_utils import execute_ibis_query, execute_ibis_query_with_count
+from .query_plan_cache import QueryPlan
+
+MAX_PAGE_SIZE = 1000
+PAGE_CACHE_EXPIRY = 60 * 5
+
+
+def fetch_page(
+    plan: QueryPlan, page_size=100, cursor=None, with_count=False
+) -> tuple[pa.Table, dict, int | None]:
+    """Fetches a page of the results and returns it with the cursor of the next page,
+    and the total row count of the query if `with_count` is set on the first page.
+
+    Sorted queries are paged with the values of the sort columns of the last row
+    (keyset pagination), so pages don't need to scan the previous rows. Ties of the
+    sorts are broken by the unique key of the rows, or by all the other columns if
+    the key isn't known, then only rows that are the same in every column are
+    skipped by count. Other queries fall back to offsets, their rows aren't sorted.
+
+    The cursor is a dict of:
+    - offset: number of rows before the page
+    - sort_values: values of the keyset columns of the last row of the previous page
+    - skip: number of rows of the previous pages with the same values
+    """
+    page_size = int(page_size)
+    if page_size <= 0 or page_size > MAX_PAGE_SIZE:
+        frappe.throw(f"Page size should be between 1 and {MAX_PAGE_SIZE}")
+
+    cursor = frappe._dict(cursor or {})
+    offset = int(cursor.offset or 0)
+
+    # one extra row is fetched to know if there is a next page
+    total_count = None
+    if with_count and not cursor:
+        # the rows and the count are fetched in one query
+        results, total_count = execute_ibis_query_with_count(
+            plan.query,
+            limit=page_size + 1,
+            cache=True,
+            cache_expiry=PAGE_CACHE_EXPIRY,
+            as_arrow=True,
+            order_by=get_sort_keys(plan),
+        )
+    else:
+        if can_use_keyset(plan, cursor):
+            query = get_keyset_query(plan, cursor.sort_values)
+            skip = int(cursor.skip or 0)
+        else:
+            query = plan.query
+            skip = offset
+        page_query = get_sorted_query(plan, query).limit(page_size + 1, offset=skip)
+        results = execute_ibis_query(
+            page_query,
+            limit=None,
+            cache=True,
+            cache_expiry=PAGE_CACHE_EXPIRY,
+            as_arrow=True,
+        )
+
+    has_more = results.num_rows > page_size
+    results = results.slice(0, page_size)
+
+    next_cursor = None
+    if has_more:
+        next_cursor = get_next_cursor(plan, results, cursor, offset)
+    return results, next_cursor, total_count
+
+
+def get_keyset_columns(plan: QueryPlan) -> list:
+    # the sorts, followed by the columns that break their ties
+    if not plan.order_by:
+        return []
+
+    tie_breakers = plan.unique_key or [
+        column
+        for column, dtype in plan.schema.items()
+        if dtype.is_numeric() or dtype.is_string() or dtype.is_temporal()
+    ]
+    sort_columns = [column for column, _ in plan.order_by]
+    return plan.order_by + [
+        (column, "asc") for column in tie_breakers if column not in sort_columns
+    ]
+
+
+def can_use_keyset(plan: QueryPlan, cursor):
+    columns = get_keyset_columns(plan)
+    if not columns or not cursor.sort_values:
+        return False
+    if len(cursor.sort_values) != len(columns):
+        return False
+    return all(column in plan.schema for column, _ in columns)
+
+
+def get_keyset_query(plan: QueryPlan, values: list) -> IbisQuery:
+    query = plan.query
+    keys = [
+        (getattr(query, column), direction, value, plan.schema[column])
+        for (column, direction), value in zip(get_keyset_columns(plan), values)
+    ]
+
+    # rows that come after the last row, in the order of the keys
+    # (a > x) or (a = x and b > y) or ...
+    conditions = []
+    for i, key in enumerate(keys):
+        conditions.append(
+            ibis.and_(*[is_equal(*previous) for previous in keys[:i]], is_after(*key))
+        )
+    if not plan.unique_key:
+        # rows that are the same as the last row, the ones already seen are skipped
+        conditions.append(ibis.and_(*[is_equal(*key) for key in keys]))
+
+    return query.filter(ibis.or_(*conditions))
+
+
+def is_after(column, direction, value, dtype):
+    # ibis sorts nulls last in both directions, on every backend,
+    # so nothing comes after a null, and nulls come after every value
+    if value is None:
+        return ibis.literal(False)
+    value = ibis.literal(value).cast(dtype)
+    after = column > value if direction == "asc" else column < value
+    return after | column.isnull()
+
+
+def is_equal(column, direction, value, dtype):
+    if value is None:
+        return column.isnull()
+    return column == ibis.literal(value).cast(dtype)
+
+
+def get_sorted_query(plan: QueryPlan, query: IbisQuery) -> IbisQuery:
+    sort_keys = get_sort_keys(plan)
+    return query.order_by(sort_keys) if sort_keys else query
+
+
+def get_sort_keys(plan: QueryPlan) -> list:
+    # rows that tie on the sorts can come in any order,
+    # so the tie breakers are sorted as well to keep the same order across pages
+    return [
+        ibis.asc(column) if direction == "asc" else ibis.desc(column)
+        for column, direction in get_keyset_columns(plan)
+    ]
+
+
+def get_next_cursor(plan: QueryPlan, results: pa.Table, cursor, offset):
+    next_cursor = {"offset": offset + results.num_rows}
+    columns = [column for column, _ in get_keyset_columns(plan)]
+    if not columns:
+        return next_cursor
+
+    rows = list(zip(*[results[column].to_pylist() for column in columns]))
+    last_values = rows[-1]
+    if plan.unique_key:
+        # no other row has the same values
+        next_cursor.update(sort_values=list(last_values), skip=0)
+        return next_cursor
+
+    ties = 0
+    for row in reversed(rows):
+        if row != last_values:
+            break
+        ties += 1
+
+    # the whole page tied with the previous page, so those rows are skipped as well
+    # (the cursor values come back from the client, so they are compared as json)
+    if (
+        ties == len(rows)
+        and cursor.sort_values
+        and frappe.as_json(list(last_values)) == frappe.as_json(cursor.sort_values)
+    ):
+        ties += int(cursor.skip or 0)
+
+    next_cursor.update(sort_values=list(last_values), skip=ties)
+    return next_cursor
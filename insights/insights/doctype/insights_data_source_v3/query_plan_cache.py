@@ -0,0 +1,292 @@
+import threading
+import time
+from collections import OrderedDict
+from copy import copy
+
+import frappe
+import ibis
+from frappe.utils import flt
+from ibis.expr.operations.relations import Aggregate, DatabaseTable, UnboundTable
+from ibis.expr.types import Table as IbisQuery
+
+from insights.cache_utils import make_digest
+from insights.insights.doctype.insights_data_source_v3.column_stats import (
+    get_table_stats,
+)
+from insights.insights.doctype.insights_data_source_v3.data_warehouse import (
+    DataWarehouse,
+    enqueue_warehouse_import,
+    get_warehouse_freshness,
+    get_warehouse_version,
+    is_warehouse_table_synced,
+)
+from insights.insights.doctype.insights_data_source_v3.warehouse_columns import (
+    backfill_missing_columns,
+)
+from insights.insights.doctype.insights_data_source_v3.warehouse_rollups import (
+    record_summary_shape,
+)
+from insights.insights.doctype.insights_data_source_v3.warehouse_sync import (
+    record_table_usage,
+)
+
+PLAN_CACHE_SIZE = 256
+PLAN_CACHE_TTL = 60 * 60
+PLAN_CACHE_VERSION_KEY = "insights:query_plan_cache_version"
+DEFAULT_SAMPLE_FRACTION = 0.1
+SAMPLE_SIZE = 100_000
+
+# built plans are kept per process, the expressions are stored unbound
+# so that they don't hold on to connections that are closed after the request
+_plan_cache: OrderedDict = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+
+class QueryPlan:
+    def __init__(
+        self,
+        query: IbisQuery,
+        tables: dict,
+        use_live_connection=True,
+        schema: ibis.Schema | None = None,
+        order_by: list | None = None,
+        unique_key: list | None = None,
+        approximate=False,
+        sample_fraction=None,
+        summary_shapes: list | None = None,
+    ):
+        self.query = query
+        self.tables = tables
+        self.use_live_connection = use_live_connection
+        self.schema = schema or query.schema()
+        # (column_name, direction) of the sorts, primary first
+        self.order_by = order_by or []
+        # columns that identify a row together, empty if they aren't known
+        self.unique_key = unique_key or []
+        self.approximate = approximate
+        self.sample_fraction = sample_fraction
+        self.summary_shapes = summary_shapes or []
+        self.created_at = time.monotonic()
+        self._sql = None
+        # the plan in the cache that this plan is bound from
+        self.cached_plan = None
+
+    @property
+    def sql(self):
+        # compiled only when needed, column lookups only need the schema,
+        # and kept on the cached plan so that it is compiled once
+        if self._sql is None:
+            self._sql = ibis.to_sql(self.query)
+            if self.cached_plan:
+                self.cached_plan._sql = self._sql
+        return self._sql
+
+    def get_source_freshness(self):
+        # live tables can change at any time, only cache expiries apply to them
+        if self.use_live_connection:
+            return None
+        return get_warehouse_freshness(self.tables.values())
+
+    def get_estimated_count(self, count):
+        # rows of a sample scale to the full table, groups of an aggregation don't
+        if not self.sample_fraction or self.query.op().find(Aggregate):
+            return count
+        return round(count / self.sample_fraction)
+
+    def is_expired(self):
+        return time.monotonic() - self.created_at > PLAN_CACHE_TTL
+
+    def unbind(self) -> "QueryPlan":
+        plan = copy(self)
+        plan.query = self.query.unbind()
+        return plan
+
+    def bind(self) -> "QueryPlan":
+        warehouse = DataWarehouse()
+        replacements = {}
+        for op in self.query.op().find(UnboundTable):
+            data_source, table_name = self.tables[op.name]
+            backend = warehouse.get_backend(
+                data_source, table_name, self.use_live_connection
+            )
+            replacements[op] = DatabaseTable(
+                name=op.name,
+                schema=op.schema,
+                source=backend,
+                namespace=op.namespace,
+            )
+
+        plan = copy(self)
+        plan.query = self.query.op().replace(replacements).to_expr()
+        plan.cached_plan = self
+        return plan
+
+
+def get_query_plan(
+    operations: list,
+    use_live_connection=True,
+    approximate=False,
+    sample_fraction=None,
+) -> QueryPlan | None:
+    from insights.insights.doctype.insights_data_source_v3.ibis_utils import (
+        IbisQueryBuilder,
+    )
+
+    if not use_live_connection:
+        tables = get_referenced_tables(operations)
+        unsynced_tables = [
+            (data_source, table_name)
+            for data_source, table_name in tables
+            if not is_warehouse_table_synced(data_source, table_name)
+        ]
+        if unsynced_tables:
+            # the whole query runs on the sources until the tables are imported,
+            # tables of different backends can't be used in the same query
+            for data_source, table_name in unsynced_tables:
+                enqueue_warehouse_import(data_source, table_name)
+            use_live_connection = True
+        elif backfill_missing_columns(operations, tables):
+            # same for the columns that were left out of the synced tables
+            use_live_connection = True
+
+    if approximate and sample_fraction is None:
+        sample_fraction = get_sample_fraction(operations)
+    # small tables aren't sampled, approximate queries only count distincts roughly
+    sample_fraction = flt(sample_fraction) if approximate and sample_fraction else None
+
+    cache_key = get_plan_cache_key(
+        operations, use_live_connection, approximate, sample_fraction
+    )
+    plan = get_cached_plan(cache_key)
+    if plan:
+        return plan.bind()
+
+    builder = IbisQueryBuilder()
+    query = builder.build(
+        operations,
+        use_live_connection,
+        approximate=approximate,
+        sample_fraction=sample_fraction,
+    )
+    if query is None:
+        return None
+
+    plan = QueryPlan(
+        query,
+        builder.tables,
+        use_live_connection,
+        schema=builder.schema,
+        order_by=builder.order_by,
+        unique_key=builder.unique_key,
+        approximate=approximate,
+        sample_fraction=sample_fraction,
+        summary_shapes=builder.summary_shapes,
+    )
+    if builder.cacheable:
+        plan.cached_plan = plan.unbind()
+        set_cached_plan(cache_key, plan.cached_plan)
+    return plan
+
+
+def record_plan_usage(plan: QueryPlan):
+    """Counts the execution of the plan, to sync the used tables first and build
+    rollups of the used summaries. Plans that are only built to list columns
+    or values aren't counted."""
+    if plan.use_live_connection:
+        return
+    record_table_usage(plan.tables.values())
+    for shape in plan.summary_shapes:
+        record_summary_shape(shape)
+
+
+def get_sample_fraction(operations: list):
+    # the sample is sized from the row count of the source table's statistics,
+    # so that approximate queries read about the same number of rows on any table
+    source = operations[0].get("table") if operations else None
+    if not source or source.get("type") != "table":
+        return DEFAULT_SAMPLE_FRACTION
+
+    stats = get_table_stats(source.get("data_source"), source.get("table_name"))
+    if not stats or not stats.row_count:
+        return DEFAULT_SAMPLE_FRACTION
+    fraction = SAMPLE_SIZE / stats.row_count
+    return fraction if fraction < 1 else None
+
+
+def get_plan_cache_key(
+    operations: list, use_live_connection=True, approximate=False, sample_fraction=None
+):
+    tables = get_referenced_tables(operations)
+    return make_digest(
+        frappe.local.site,
+        get_plan_cache_version(),
+        # warehouse plans are built again after a table is synced,
+        # as the schemas and the pivot columns can change with the data
+        None if use_live_connection else get_warehouse_version(),
+        frappe.as_json(operations, indent=None),
+        bool(use_live_connection),
+        bool(approximate),
+        sample_fraction,
+        get_restrictions_fingerprint(tables),
+    )
+
+
+def get_referenced_tables(operations: list) -> set[tuple[str, str]]:
+    tables = set()
+    for operation in operations or []:
+        table = operation.get("table")
+        if not table:
+            continue
+        if table.get("type") == "query":
+            tables.update(get_referenced_tables(table.get("operations")))
+        elif table.get("data_source") and table.get("table_name"):
+            tables.add((table["data_source"], table["table_name"]))
+    return tables
+
+
+def get_restrictions_fingerprint(tables: set[tuple[str, str]]):
+    from insights.insights.doctype.insights_team.insights_team import (
+        check_table_permission,
+        get_table_restrictions,
+    )
+
+    # permissions are checked here since a cached plan skips the build
+    restrictions = []
+    for data_source, table_name in sorted(tables):
+        check_table_permission(data_source, table_name)
+        restrictions.append(
+            [data_source, table_name, get_table_restrictions(data_source, table_name)]
+        )
+    return make_digest(frappe.as_json(restrictions, indent=None))
+
+
+def get_cached_plan(cache_key) -> QueryPlan | None:
+    with _plan_cache_lock:
+        plan = _plan_cache.get(cache_key)
+        if plan is None:
+            return None
+        if plan.is_expired():
+            del _plan_cache[cache_key]
+            return None
+        _plan_cache.move_to_end(cache_key)
+        return plan
+
+
+def set_cached_plan(cache_key, plan: QueryPlan):
+    with _plan_cache_lock:
+        _plan_cache[cache_key] = plan
+        _plan_cache.move_to_end(cache_key)
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+
+
+def get_plan_cache_version():
+    return frappe.cache().get_value(PLAN_CACHE_VERSION_KEY) or 0
+
+
+def clear_query_plan_cache():
+    # the version is part of the cache key, so bumping it
+    # invalidates the cached plans of every worker process
+    frappe.cache().set_value(PLAN_CACHE_VERSION_KEY, frappe.generate_hash(length=10))
+    with _plan_cache_lock:
+        _plan_cache.clear()
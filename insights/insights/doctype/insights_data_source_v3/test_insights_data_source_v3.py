@@ -1,9 +1,297 @@
 # Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
-# import frappe
+import datetime
+
+import frappe
+import ibis
 from frappe.tests.utils import FrappeTestCase
 
+from insights.utils import deep_convert_dict_to_dict as _dict
+
+from .column_values import match_values, search_column_values
+from .ibis_utils import IbisQueryBuilder, compile_safe_exec, exec_with_return
+from .query_pagination import fetch_page, get_keyset_query, get_sort_keys
+from .query_plan_cache import QueryPlan
+from .warehouse_columns import get_identifiers
+
 
 class TestInsightsDataSourcev3(FrappeTestCase):
     pass
+
+
+class TestIbisQueryBuilder(FrappeTestCase):
+    def setUp(self):
+        self.db = ibis.duckdb.connect()
+        self.sales = self.db.create_table(
+            "sales",
+            ibis.memtable(
+                {
+                    "region": ["North", "South", "North", "East"],
+                    "year": [2023, 2024, 2024, 9],
+                    "posting_date": [
+                        datetime.date(2024, 1, 5),
+                        datetime.date(2024, 2, 10),
+                        datetime.date(2024, 2, 20),
+                        datetime.date(2024, 11, 1),
+                    ],
+                    "amount": [10.0, 20.0, 30.0, 40.0],
+                }
+            ),
+        )
+
+    def tearDown(self):
+        self.db.disconnect()
+
+    def get_builder(self, table):
+        builder = IbisQueryBuilder()
+        builder.build([])
+        builder.query = table
+        builder.set_schema()
+        return builder
+
+    def get_pivot(self, column):
+        pivot = _dict(
+            {
+                "rows": [{"column_name": "region", "data_type": "String"}],
+                "columns": [column],
+                "values": [
+                    {
+                        "measure_name": "total",
+                        "column_name": "amount",
+                        "aggregation": "sum",
+                        "data_type": "Decimal",
+                    }
+                ],
+            }
+        )
+        return self.get_builder(self.sales).apply_pivot(pivot, "wider")
+
+    def test_pivot_on_date_column(self):
+        pivot = self.get_pivot(
+            {"column_name": "posting_date", "data_type": "Date", "granularity": "month"}
+        )
+        self.assertEqual(
+            pivot.columns, ["region", "2024-01-01", "2024-02-01", "2024-11-01"]
+        )
+        results = pivot.order_by("region").to_pyarrow().to_pylist()
+        self.assertEqual(results[1]["2024-02-01"], 30.0)
+
+    def test_pivot_on_int_column(self):
+        pivot = self.get_pivot({"column_name": "year", "data_type": "Integer"})
+        # the columns are in the order of the values, not of their text
+        self.assertEqual(pivot.columns, ["region", "9", "2023", "2024"])
+        results = pivot.order_by("region").to_pyarrow().to_pylist()
+        self.assertEqual(results[2]["2024"], 20.0)
+
+    def test_sort_keys_follow_the_columns(self):
+        builder = self.get_builder(self.sales)
+        operations = [
+            {
+                "type": "order_by",
+                "column": {"column_name": "amount"},
+                "direction": "desc",
+            },
+            {
+                "type": "order_by",
+                "column": {"column_name": "region"},
+                "direction": "asc",
+            },
+            {
+                "type": "rename",
+                "column": {"column_name": "amount"},
+                "new_name": "total",
+            },
+            {"type": "remove", "column_names": ["region"]},
+        ]
+        for operation in operations:
+            builder.query = builder.perform_operation(operation)
+            builder.set_schema()
+        self.assertEqual(builder.order_by, [("total", "desc")])
+
+    def test_unique_key_of_summaries(self):
+        builder = self.get_builder(self.sales)
+        operations = [
+            {
+                "type": "summarize",
+                "measures": [
+                    {
+                        "measure_name": "total",
+                        "column_name": "amount",
+                        "aggregation": "sum",
+                        "data_type": "Decimal",
+                    }
+                ],
+                "dimensions": [
+                    {"column_name": "region", "data_type": "String"},
+                    {"column_name": "year", "data_type": "Integer"},
+                ],
+            },
+            {
+                "type": "rename",
+                "column": {"column_name": "year"},
+                "new_name": "fiscal_year",
+            },
+        ]
+        for operation in operations:
+            builder.query = builder.perform_operation(operation)
+            builder.set_schema()
+        self.assertEqual(builder.unique_key, ["region", "fiscal_year"])
+
+        builder.query = builder.perform_operation(
+            {"type": "remove", "column_names": ["region"]}
+        )
+        builder.set_schema()
+        self.assertEqual(builder.unique_key, [])
+
+
+class TestQueryPagination(FrappeTestCase):
+    def setUp(self):
+        self.db = ibis.duckdb.connect()
+        # a sort column with nulls and ties
+        self.items = self.db.create_table(
+            "items",
+            ibis.memtable(
+                {
+                    "id": list(range(53)),
+                    "score": [None if i % 5 == 0 else i % 7 for i in range(53)],
+                }
+            ),
+        )
+
+    def tearDown(self):
+        self.db.disconnect()
+
+    def fetch_all_pages(self, plan, page_size):
+        rows = []
+        results, cursor, total_count = fetch_page(plan, page_size, with_count=True)
+        rows.extend(results.to_pylist())
+        while cursor:
+            # the cursor goes through the client as json
+            cursor = frappe.parse_json(frappe.as_json(cursor))
+            results, cursor, _ = fetch_page(plan, page_size, cursor)
+            rows.extend(results.to_pylist())
+        self.assertEqual(total_count, 53)
+        return [row["id"] for row in rows]
+
+    def test_keyset_pages_with_nulls(self):
+        rows = self.items.to_pyarrow().to_pylist()
+        # nulls come last in both directions, ties are ordered by the other columns,
+        # or by the unique key if it is known
+        for direction, sign in (("asc", 1), ("desc", -1)):
+            order_fn = ibis.asc if direction == "asc" else ibis.desc
+            expected = sorted(
+                rows,
+                key=lambda r: (r["score"] is None, sign * (r["score"] or 0), r["id"]),
+            )
+            for unique_key in (None, ["id"]):
+                plan = QueryPlan(
+                    self.items.order_by(order_fn("score")),
+                    tables={},
+                    order_by=[("score", direction)],
+                    unique_key=unique_key,
+                )
+                for page_size in (3, 10):
+                    self.assertEqual(
+                        self.fetch_all_pages(plan, page_size),
+                        [row["id"] for row in expected],
+                    )
+
+    def test_keyset_pages_without_offsets(self):
+        plan = QueryPlan(
+            self.items.order_by("score"),
+            tables={},
+            order_by=[("score", "asc")],
+            unique_key=["id"],
+        )
+        cursor = fetch_page(plan, 10)[1]
+        self.assertEqual(cursor["skip"], 0)
+        sql = ibis.to_sql(get_keyset_query(plan, cursor["sort_values"]))
+        self.assertNotIn("OFFSET", sql.upper())
+
+    def test_offset_pages(self):
+        plan = QueryPlan(self.items, tables={})
+        # unsorted results aren't sorted to be paged
+        self.assertEqual(get_sort_keys(plan), [])
+        self.assertEqual(self.fetch_all_pages(plan, 10), list(range(53)))
+
+
+class TestExecWithReturn(FrappeTestCase):
+    def test_expression(self):
+        self.assertEqual(exec_with_return("a + 1", {"a": 1}), 2)
+        # the compiled expression is cached, the values aren't
+        self.assertEqual(exec_with_return("a + 1", {"a": 2}), 3)
+
+    def test_statements(self):
+        code = "b = a * 2\nc = b + 1\nc * 10"
+        self.assertEqual(exec_with_return(code, {"a": 2}), 50)
+        # the statements are compiled once as well
+        hits = compile_safe_exec.cache_info().hits
+        self.assertEqual(exec_with_return(code, {"a": 3}), 70)
+        self.assertEqual(compile_safe_exec.cache_info().hits, hits + 1)
+
+    def test_restricted_expression(self):
+        self.assertRaises(SyntaxError, exec_with_return, "a._b", {"a": 1})
+
+
+class TestColumnValues(FrappeTestCase):
+    def test_match_values(self):
+        values = ["Pune", "Mumbai", "Surat", "Puducherry", None]
+        self.assertEqual(match_values(values, limit=2), ["Pune", "Mumbai"])
+        # prefix matches come before the values that only contain the term
+        self.assertEqual(match_values(values, "pu"), ["Pune", "Puducherry"])
+        self.assertEqual(match_values(values, "ur"), ["Surat"])
+        self.assertEqual(match_values(values, "u", limit=1), ["Pune"])
+
+    def search(self, key, value_counts, search_term, max_values):
+        searches = []
+
+        def search_source(search_term, limit):
+            searches.append(search_term)
+            return ["source"]
+
+        results = search_column_values(
+            key,
+            lambda limit: value_counts[:limit],
+            search_source,
+            search_term,
+            limit=2,
+            max_values=max_values,
+        )
+        return results, searches
+
+    def test_search_column_values(self):
+        value_counts = [("North", 5), ("South", 3), ("East", 1)]
+        results, searches = self.search("test_complete_values", value_counts, "th", 10)
+        self.assertEqual(results, ["North", "South"])
+        # the cached values are complete, the source isn't searched
+        results, searches = self.search(
+            "test_complete_values", value_counts, "west", 10
+        )
+        self.assertEqual((results, searches), ([], []))
+
+    def test_search_incomplete_column_values(self):
+        value_counts = [("North", 5), ("South", 3), ("East", 1)]
+        # too few of the cached values match, the source is searched
+        results, searches = self.search(
+            "test_incomplete_values", value_counts, "North", 2
+        )
+        self.assertEqual((results, searches), (["source"], ["North"]))
+        results, searches = self.search("test_incomplete_values", value_counts, None, 2)
+        self.assertEqual((results, searches), (["North", "South"], []))
+
+
+class TestWarehouseColumns(FrappeTestCase):
+    def test_identifiers(self):
+        operations = [
+            {"type": "select", "column_names": ["Customer Name", "order-id", "città"]},
+            {"type": "mutate", "expression": {"expression": "amount * 2 + größe"}},
+        ]
+        identifiers = get_identifiers(operations)
+        for column in ("Customer Name", "order-id", "città", "amount", "größe"):
+            self.assertIn(column, identifiers)
+
+        # restrictions quote the names that aren't identifiers
+        identifiers = get_identifiers('`Sales Region` = "North" and status = 1')
+        for column in ("Sales Region", "status"):
+            self.assertIn(column, identifiers)
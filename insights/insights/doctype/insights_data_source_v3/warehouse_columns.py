@@ -0,0 +1,165 @@
+import re
+
+import frappe
+from ibis.backends.sql.datatypes import DuckDBType
+from ibis.expr.types import Table as IbisQuery
+
+# columns used in expressions and restrictions, other column names are only
+# found as the whole values of the operations
+IDENTIFIER = re.compile(r"[^\W\d]\w*")
+QUOTED_NAME = re.compile(r"`([^`]+)`|\"([^\"]+)\"|'([^']+)'")
+REQUESTED_COLUMNS_KEY_PREFIX = "insights:warehouse_requested_columns:"
+BACKFILL_JOB_TIMEOUT = 60 * 60
+
+
+def get_sync_columns(data_source, table_name, table: IbisQuery, settings):
+    """Returns the columns of the source table that are synced to the warehouse.
+
+    Tables that sync only the used columns get the columns referenced by saved
+    workbooks and table restrictions, the columns requested by queries since,
+    and the columns listed to always sync. The columns needed to sync the table
+    are always synced, and listed exclusions apply to every table.
+    """
+    required = {
+        settings.primary_key,
+        settings.watermark_column,
+        settings.partition_column,
+        "creation",
+    }
+    excluded = parse_column_list(settings.exclude_columns)
+
+    columns = table.columns
+    if settings.sync_used_columns:
+        used = (
+            get_used_columns(data_source, table_name)
+            | get_requested_columns(data_source, table_name)
+            | parse_column_list(settings.include_columns)
+        )
+        columns = [c for c in columns if c in used or c in required]
+
+    return [c for c in columns if c in required or c not in excluded]
+
+
+def get_unsynced_column_types(table: IbisQuery, columns):
+    # the types are kept so that the columns can still be listed in the warehouse
+    schema = table.schema()
+    return {
+        column: DuckDBType.to_string(dtype)
+        for column, dtype in schema.items()
+        if column not in columns
+    }
+
+
+def get_used_columns(data_source, table_name):
+    # every name in the workbooks that query the table is taken as a column,
+    # names that aren't columns of the table are dropped by the caller
+    from insights.insights.doctype.insights_table_v3.insights_table_v3 import (
+        get_table_name,
+    )
+
+    workbooks = frappe.get_all(
+        "Insights Workbook",
+        filters={"queries": ["like", f"%{table_name}%"]},
+        fields=["queries", "charts", "dashboards"],
+    )
+    restrictions = frappe.get_all(
+        "Insights Resource Permission",
+        filters={
+            "resource_type": "Insights Table v3",
+            "resource_name": get_table_name(data_source, table_name),
+            "table_restrictions": ["is", "set"],
+        },
+        pluck="table_restrictions",
+    )
+
+    columns = set()
+    for workbook in workbooks:
+        for value in workbook.values():
+            columns |= get_identifiers(frappe.parse_json(value or "null"))
+    for restriction in restrictions:
+        columns |= get_identifiers(restriction)
+    return columns
+
+
+def get_identifiers(value):
+    # only the values are searched, the keys of the operations aren't column names.
+    # A value is a name as a whole, or an expression that uses names or quotes them
+    if isinstance(value, str):
+        quoted = {name for match in QUOTED_NAME.findall(value) for name in match}
+        return {value} | set(IDENTIFIER.findall(value)) | (quoted - {""})
+    if isinstance(value, dict):
+        return get_identifiers(list(value.values()))
+    if isinstance(value, list | tuple):
+        return set().union(*map(get_identifiers, value))
+    return set()
+
+
+def parse_column_list(text):
+    return {
+        c.strip() for c in (text or "").replace(",", "\n").splitlines() if c.strip()
+    }
+
+
+def get_unsynced_columns(data_source, table_name):
+    """Returns the columns left out of the last sync of the table, by their
+    duckdb type, except the ones that are excluded from the sync."""
+    table = frappe.db.get_value(
+        "Insights Table v3",
+        {"data_source": data_source, "table": table_name},
+        ["unsynced_columns", "exclude_columns"],
+        as_dict=True,
+        cache=True,
+    )
+    if not table or not table.unsynced_columns:
+        return {}
+
+    excluded = parse_column_list(table.exclude_columns)
+    columns = frappe.parse_json(table.unsynced_columns)
+    return {c: t for c, t in columns.items() if c not in excluded}
+
+
+def backfill_missing_columns(operations, tables):
+    """Requests the columns used by the query that were left out of the synced
+    tables, and syncs the tables again in the background.
+
+    Returns True if a table is missing any column, the query can't run on the
+    warehouse until the columns are synced.
+    """
+    identifiers = get_identifiers(operations)
+    backfill = False
+    for data_source, table_name in tables:
+        missing = identifiers & set(get_unsynced_columns(data_source, table_name))
+        if not missing:
+            continue
+
+        backfill = True
+        frappe.cache().sadd(
+            get_requested_columns_key(data_source, table_name), *missing
+        )
+        frappe.enqueue(
+            "insights.insights.doctype.insights_data_source_v3.warehouse_sync.sync_warehouse_tables",
+            queue="long",
+            timeout=BACKFILL_JOB_TIMEOUT,
+            job_id=f"insights_warehouse_backfill::{data_source}::{table_name}",
+            deduplicate=True,
+            tables=[(data_source, table_name)],
+        )
+    return backfill
+
+
+def get_requested_columns(data_source, table_name):
+    key = get_requested_columns_key(data_source, table_name)
+    return {frappe.safe_decode(c) for c in frappe.cache().smembers(key)}
+
+
+def get_requested_columns_key(data_source, table_name):
+    return f"{REQUESTED_COLUMNS_KEY_PREFIX}{data_source}:{table_name}"
+
+
+def get_placeholder_columns_sql(data_source, table_name):
+    # columns that aren't synced are listed as nulls, so that they can be picked
+    # in the query builder, using them syncs them again
+    return ", ".join(
+        f'CAST(NULL AS {column_type}) AS "{column}"'
+        for column, column_type in get_unsynced_columns(data_source, table_name).items()
+    )
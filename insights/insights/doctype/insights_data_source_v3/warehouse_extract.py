@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+
+import frappe
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from ibis import BaseBackend
+from ibis.expr.types import Table as IbisQuery
+
+EXTRACT_BATCH_SIZE = 100_000
+
+
+def extract_to_parquet(table: IbisQuery, path, batch_size=EXTRACT_BATCH_SIZE):
+    """Writes the rows of a source table to a parquet file, one row group per batch.
+
+    MariaDB and PostgreSQL results are read through a server side cursor, so only
+    one batch of rows is held in memory, whatever the size of the table.
+    """
+    backend = table._find_backend()
+    schema = table.schema()
+    arrow_schema = schema.to_pyarrow()
+
+    with pq.ParquetWriter(path, arrow_schema, compression="snappy") as writer:
+        for batch in get_record_batches(backend, table, batch_size):
+            writer.write_table(pa.Table.from_batches([batch], schema=arrow_schema))
+
+
+def get_record_batches(backend: BaseBackend, table: IbisQuery, batch_size):
+    if backend.name not in ("mysql", "postgres"):
+        # the other sources are local files that are already read in batches
+        yield from table.to_pyarrow_batches(chunk_size=batch_size)
+        return
+
+    schema = table.schema()
+    arrow_schema = schema.to_pyarrow()
+    converter = get_pandas_converter(backend)
+    sql = backend.compile(table)
+    with open_server_side_cursor(backend, sql, batch_size) as cursor:
+        while rows := cursor.fetchmany(batch_size):
+            # the backend's conversions keep the types the same as ibis' exports
+            df = pd.DataFrame.from_records(
+                rows, columns=schema.names, coerce_float=True
+            )
+            df = converter.convert_table(df, schema)
+            yield pa.RecordBatch.from_pandas(
+                df, schema=arrow_schema, preserve_index=False
+            )
+
+
+def get_pandas_converter(backend: BaseBackend):
+    if backend.name == "mysql":
+        from ibis.backends.mysql.converter import MySQLPandasData
+
+        return MySQLPandasData
+
+    from ibis.backends.postgres.converter import PostgresPandasData
+
+    return PostgresPandasData
+
+
+@contextmanager
+def open_server_side_cursor(backend: BaseBackend, sql, batch_size):
+    con = backend.con
+    if backend.name == "mysql":
+        from pymysql.cursors import SSCursor
+
+        cursor = con.cursor(SSCursor)
+        try:
+            cursor.execute(sql)
+            yield cursor
+        finally:
+            # reads the remaining rows, if any, so that the connection can be reused
+            cursor.close()
+
+    elif backend.name == "postgres":
+        # named cursors are declared on the server and live until the transaction ends
+        cursor = con.cursor(name=f"insights_extract_{frappe.generate_hash(length=8)}")
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(sql)
+            yield cursor
+            cursor.close()
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
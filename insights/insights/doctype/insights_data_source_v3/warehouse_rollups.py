@@ -0,0 +1,255 @@
+import json
+import os
+
+import frappe
+import frappe.utils
+import ibis
+from ibis import _
+from ibis.expr.types import Table as IbisQuery
+
+from insights.cache_utils import make_digest
+
+from .data_warehouse import (
+    get_parquet_filepath,
+    get_table_sql,
+    get_warehouse_freshness,
+    quote_path,
+    replace_path,
+)
+
+ROLLUP_USAGE_KEY_PREFIX = "insights:warehouse_rollup_usage:"
+ROLLUP_USAGE_DAYS = 7
+# summaries used fewer times than this in the last days don't get a rollup
+ROLLUP_MIN_USES = 20
+MAX_ROLLUPS_PER_TABLE = 5
+# measures that can be computed again from the measures of a finer rollup
+ROLLUP_AGGREGATIONS = ("sum", "count", "min", "max", "avg")
+ROW_COUNT = "__count__"
+
+
+def get_summary_shape(data_source, table_name, dimensions, measures):
+    """Returns the shape of a summary of a warehouse table, or None if the summary
+    can't be answered from a rollup."""
+    shape_dimensions = []
+    for dimension in dimensions:
+        # weeks depend on a setting that can change after the rollup is built
+        if dimension.get("granularity") == "week":
+            return None
+        shape_dimensions.append(
+            {
+                "column_name": dimension.column_name,
+                "data_type": dimension.data_type,
+                "granularity": dimension.get("granularity")
+                if dimension.data_type in ("Date", "Time", "Datetime")
+                else None,
+            }
+        )
+
+    shape_measures = []
+    for measure in measures:
+        if "expression" in measure or measure.aggregation not in ROLLUP_AGGREGATIONS:
+            return None
+        shape_measures.append(
+            {"column_name": measure.column_name, "aggregation": measure.aggregation}
+        )
+
+    column_names = [d["column_name"] for d in shape_dimensions]
+    if len(set(column_names)) != len(column_names):
+        return None
+
+    return frappe._dict(
+        data_source=data_source,
+        table_name=table_name,
+        dimensions=sorted(shape_dimensions, key=frappe.as_json),
+        measures=sorted(shape_measures, key=frappe.as_json),
+    )
+
+
+def record_summary_shape(shape):
+    cache = frappe.cache()
+    key = cache.make_key(f"{ROLLUP_USAGE_KEY_PREFIX}{frappe.utils.nowdate()}")
+    pipeline = cache.pipeline()
+    pipeline.zincrby(key, 1, json.dumps(shape, sort_keys=True))
+    pipeline.expire(key, ROLLUP_USAGE_DAYS * 24 * 60 * 60)
+    pipeline.execute()
+
+
+def get_hot_shapes(data_source, table_name):
+    cache = frappe.cache()
+    today = frappe.utils.getdate()
+    uses = {}
+    for days in range(ROLLUP_USAGE_DAYS):
+        date = frappe.utils.add_days(today, -days)
+        key = cache.make_key(f"{ROLLUP_USAGE_KEY_PREFIX}{date}")
+        for shape, count in cache.zrange(key, 0, -1, withscores=True):
+            shape = frappe.safe_decode(shape)
+            uses[shape] = uses.get(shape, 0) + count
+
+    shapes = [
+        (count, frappe._dict(json.loads(shape)))
+        for shape, count in uses.items()
+        if count >= ROLLUP_MIN_USES
+    ]
+    shapes = [
+        (count, shape)
+        for count, shape in shapes
+        if shape.data_source == data_source and shape.table_name == table_name
+    ]
+    shapes.sort(key=lambda s: s[0], reverse=True)
+    return [shape for _, shape in shapes[:MAX_ROLLUPS_PER_TABLE]]
+
+
+def find_rollup(shape):
+    """Returns the smallest rollup that has all the dimensions and measures
+    of the shape, and is built from the current files of the table."""
+    manifest = get_rollup_manifest(shape.data_source, shape.table_name)
+    if not manifest:
+        return None
+
+    freshness = get_warehouse_freshness([(shape.data_source, shape.table_name)])
+    if manifest.get("freshness") != freshness:
+        return None
+
+    columns = get_rollup_columns(shape)
+    matches = [
+        frappe._dict(rollup)
+        for rollup in manifest["rollups"]
+        if all(d in rollup["dimensions"] for d in shape.dimensions)
+        and columns.issubset(rollup["columns"])
+    ]
+    return min(matches, key=lambda r: r.row_count) if matches else None
+
+
+def summarize_rollup(rollup_table: IbisQuery, measures: dict, schema) -> IbisQuery:
+    """Aggregates the rollup to the dimensions of the summary. `measures` maps the
+    names of the summary's measures to their column and aggregation, and `schema`
+    is the schema the summary of the table would have had."""
+    aggregates = {
+        name: get_rollup_aggregate(rollup_table, measure).cast(schema[name])
+        for name, measure in measures.items()
+    }
+    # the dimensions come first in the schema, in the order of the summary
+    group_bys = [
+        rollup_table[column].cast(schema[column])
+        for column in schema.names
+        if column not in measures
+    ]
+    return rollup_table.aggregate(**aggregates, by=group_bys)
+
+
+def get_rollup_aggregate(rollup_table: IbisQuery, measure):
+    column, aggregation = measure["column_name"], measure["aggregation"]
+    if column == "count" and aggregation == "count":
+        return rollup_table[ROW_COUNT].sum()
+    if aggregation == "avg":
+        total = rollup_table[get_rollup_column_name("sum", column)].sum()
+        count = rollup_table[get_rollup_column_name("count", column)].sum()
+        return total / count.nullif(0)
+    if aggregation in ("sum", "count"):
+        return rollup_table[get_rollup_column_name(aggregation, column)].sum()
+    if aggregation == "min":
+        return rollup_table[get_rollup_column_name("min", column)].min()
+    return rollup_table[get_rollup_column_name("max", column)].max()
+
+
+def get_rollup_columns(shape):
+    columns = set()
+    for measure in shape.measures:
+        column, aggregation = measure["column_name"], measure["aggregation"]
+        if column == "count" and aggregation == "count":
+            columns.add(ROW_COUNT)
+        elif aggregation == "avg":
+            columns.add(get_rollup_column_name("sum", column))
+            columns.add(get_rollup_column_name("count", column))
+        else:
+            columns.add(get_rollup_column_name(aggregation, column))
+    return columns
+
+
+def get_rollup_column_name(aggregation, column):
+    return f"__{aggregation}__{column}"
+
+
+def refresh_rollups(data_source, table_name):
+    """Builds the rollups of the most used summaries of the table again, from the
+    table's current files. Rollups of summaries that are no longer used are
+    removed."""
+    shapes = get_hot_shapes(data_source, table_name)
+    folder = get_rollups_folder_path(data_source, table_name)
+    manifest_path = os.path.join(folder, "manifest.json")
+    if not shapes and not os.path.exists(folder):
+        return
+
+    os.makedirs(folder, exist_ok=True)
+    freshness = get_warehouse_freshness([(data_source, table_name)])
+    rollups = [build_rollup(data_source, table_name, shape) for shape in shapes]
+
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"freshness": freshness, "rollups": rollups}, f)
+    os.replace(tmp_path, manifest_path)
+
+    files = {os.path.basename(rollup["path"]) for rollup in rollups}
+    for file in os.listdir(folder):
+        if file.endswith(".parquet") and file not in files:
+            os.remove(os.path.join(folder, file))
+
+
+def build_rollup(data_source, table_name, shape):
+    from .ibis_utils import IbisQueryBuilder
+
+    builder = IbisQueryBuilder()
+    group_bys = [
+        builder.translate_dimension(frappe._dict(dimension))
+        for dimension in shape.dimensions
+    ]
+
+    aggregates = {}
+    for column in sorted(get_rollup_columns(shape)):
+        if column == ROW_COUNT:
+            aggregates[column] = _.count()
+            continue
+        aggregation, column_name = column[2:].split("__", 1)
+        aggregates[column] = getattr(_[column_name], aggregation)()
+
+    name = make_digest(json.dumps(shape, sort_keys=True))
+    path = os.path.join(
+        get_rollups_folder_path(data_source, table_name), f"{name}.parquet"
+    )
+
+    db = ibis.duckdb.connect()
+    try:
+        db.raw_sql(f"CREATE TEMP VIEW base AS {get_table_sql(data_source, table_name)}")
+        rollup = db.table("base").aggregate(**aggregates, by=group_bys)
+        db.raw_sql(
+            f"COPY ({ibis.to_sql(rollup)}) TO '{quote_path(path)}.tmp' "
+            "(FORMAT PARQUET, COMPRESSION SNAPPY)"
+        )
+        row_count = db.raw_sql(
+            f"SELECT count(*) FROM read_parquet('{quote_path(path)}.tmp')"
+        ).fetchone()[0]
+    finally:
+        db.disconnect()
+
+    replace_path(f"{path}.tmp", path)
+    return {
+        "name": name,
+        "path": path,
+        "dimensions": shape.dimensions,
+        "columns": sorted(aggregates),
+        "row_count": row_count,
+    }
+
+
+def get_rollup_manifest(data_source, table_name):
+    path = os.path.join(
+        get_rollups_folder_path(data_source, table_name), "manifest.json"
+    )
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_rollups_folder_path(data_source, table_name):
+    return get_parquet_filepath(data_source, table_name) + ".rollups"
@@ -0,0 +1,125 @@
+import os
+
+import frappe
+import frappe.utils
+
+from .data_warehouse import DataWarehouse, get_parquet_filepath
+
+MAX_PARALLEL_SYNCS = 2
+SYNC_JOB_TIMEOUT = 60 * 60
+TABLE_USAGE_KEY_PREFIX = "insights:warehouse_table_usage:"
+TABLE_USAGE_DAYS = 7
+
+
+def sync_stale_warehouse_tables():
+    """Imports the synced tables that are older than their sync interval again.
+
+    Tables that were queried the most in the last days are synced first. The tables
+    are split between MAX_PARALLEL_SYNCS jobs on the long queue that sync their
+    tables one after another, so that the sources aren't flooded with imports.
+    """
+    tables = get_stale_tables()
+    if not tables:
+        return
+
+    usage = get_table_usage()
+    tables.sort(
+        key=lambda t: (
+            -usage.get(get_table_usage_key(t.data_source, t.table), 0),
+            t.last_synced_on or frappe.utils.get_datetime("1900-01-01"),
+        )
+    )
+
+    for i in range(MAX_PARALLEL_SYNCS):
+        # every job gets tables from the whole priority order
+        job_tables = [(t.data_source, t.table) for t in tables[i::MAX_PARALLEL_SYNCS]]
+        if not job_tables:
+            continue
+        # a job that is still syncing from the previous run isn't enqueued again
+        frappe.enqueue(
+            "insights.insights.doctype.insights_data_source_v3.warehouse_sync.sync_warehouse_tables",
+            queue="long",
+            timeout=SYNC_JOB_TIMEOUT,
+            job_id=f"insights_warehouse_sync::{i}",
+            deduplicate=True,
+            tables=job_tables,
+        )
+
+
+def get_stale_tables():
+    source_intervals = dict(
+        frappe.get_all(
+            "Insights Data Source v3",
+            filters={"status": "Active"},
+            fields=["name", "sync_interval"],
+            as_list=True,
+        )
+    )
+    tables = frappe.get_all(
+        "Insights Table v3",
+        filters={"data_source": ["in", list(source_intervals)]},
+        fields=["data_source", "table", "sync_interval", "last_synced_on"],
+    )
+
+    now = frappe.utils.now_datetime()
+    stale_tables = []
+    for table in tables:
+        interval = table.sync_interval or source_intervals.get(table.data_source)
+        if not interval:
+            continue
+        # only the tables that are already in the warehouse are kept fresh
+        if not os.path.exists(get_parquet_filepath(table.data_source, table.table)):
+            continue
+        if table.last_synced_on and table.last_synced_on > frappe.utils.add_to_date(
+            now, hours=-interval
+        ):
+            continue
+        stale_tables.append(table)
+
+    return stale_tables
+
+
+def sync_warehouse_tables(tables):
+    from .insights_data_source_v3 import after_request, before_request
+
+    # connections are set up per request, do the same for the job
+    before_request()
+    try:
+        warehouse = DataWarehouse()
+        for data_source, table_name in tables:
+            try:
+                warehouse.sync_remote_table(data_source, table_name)
+                frappe.db.commit()
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(f"Failed to sync {table_name} of {data_source}")
+    finally:
+        after_request()
+
+
+def record_table_usage(tables):
+    """Counts the warehouse queries of the tables, to sync the used tables first."""
+    cache = frappe.cache()
+    key = cache.make_key(f"{TABLE_USAGE_KEY_PREFIX}{frappe.utils.nowdate()}")
+    pipeline = cache.pipeline()
+    for data_source, table_name in set(tables):
+        pipeline.zincrby(key, 1, get_table_usage_key(data_source, table_name))
+    pipeline.expire(key, TABLE_USAGE_DAYS * 24 * 60 * 60)
+    pipeline.execute()
+
+
+def get_table_usage():
+    cache = frappe.cache()
+    today = frappe.utils.getdate()
+    usage = {}
+    for days in range(TABLE_USAGE_DAYS):
+        date = frappe.utils.add_days(today, -days)
+        key = cache.make_key(f"{TABLE_USAGE_KEY_PREFIX}{date}")
+        for table, count in cache.zrange(key, 0, -1, withscores=True):
+            table = frappe.safe_decode(table)
+            usage[table] = usage.get(table, 0) + count
+    return usage
+
+
+def get_table_usage_key(data_source, table_name):
+    return f"{data_source}|{table_name}"
@@ -22,6 +22,8 @@ class InsightsSettings(Document):
         auto_execute_query: DF.Check
         enable_permissions: DF.Check
         fiscal_year_start: DF.Date | None
+        max_export_rows: DF.Int
+        max_export_size: DF.Int
         max_records_to_sync: DF.Int
         onboarding_complete: DF.Check
         query_result_expiry: DF.Int
@@ -37,6 +39,15 @@ class InsightsSettings(Document):
         if self.setup_complete and not self.get_doc_before_save().setup_complete:
             sync_site_tables()
 
+    def on_update(self):
+        if self.has_value_changed("week_starts_on"):
+            # week granularity is translated using this setting
+            from insights.insights.doctype.insights_data_source_v3.query_plan_cache import (
+                clear_query_plan_cache,
+            )
+
+            clear_query_plan_cache()
+
     @frappe.whitelist()
     def update_settings(self, settings):
         settings = frappe.parse_json(settings)
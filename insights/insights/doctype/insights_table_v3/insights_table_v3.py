@@ -10,6 +10,9 @@ from frappe.model.document import Document, bulk_insert
 from insights.insights.doctype.insights_data_source_v3.data_warehouse import (
     DataWarehouse,
 )
+from insights.insights.doctype.insights_data_source_v3.query_plan_cache import (
+    clear_query_plan_cache,
+)
 
 
 class InsightsTablev3(Document):
@@ -25,16 +28,44 @@ class InsightsTablev3(Document):
             InsightsTableColumn,
         )
 
+        column_stats: DF.JSON | None
         columns: DF.Table[InsightsTableColumn]
         data_source: DF.Link
+        exclude_columns: DF.SmallText | None
+        include_columns: DF.SmallText | None
+        incremental_sync: DF.Check
         label: DF.Data
         last_synced_on: DF.Datetime | None
+        partition_by: DF.Literal["", "Month", "Year"]
+        partition_column: DF.Data | None
+        primary_key: DF.Data | None
+        row_count: DF.Int
+        sync_interval: DF.Int
+        sync_used_columns: DF.Check
         table: DF.Data
+        unsynced_columns: DF.JSON | None
+        watermark: DF.Data | None
+        watermark_column: DF.Data | None
     # end: auto-generated types
 
     def autoname(self):
         self.name = get_table_name(self.data_source, self.table)
 
+    def on_update(self):
+        # cached plans keep the schema of the table they were built with
+        if self.has_columns_changed():
+            clear_query_plan_cache()
+
+    def has_columns_changed(self):
+        doc_before = self.get_doc_before_save()
+        if not doc_before:
+            return False
+
+        def get_columns(doc):
+            return [(c.column, c.type) for c in doc.columns]
+
+        return get_columns(doc_before) != get_columns(self)
+
     @staticmethod
     def bulk_create(data_source: str, tables: list[str]):
         table_docs = []
@@ -67,11 +98,8 @@ class InsightsTablev3(Document):
     @frappe.whitelist()
     def import_to_data_warehouse(self):
         frappe.only_for("Insights Admin")
-        DataWarehouse().import_remote_table(
-            self.data_source,
-            self.table,
-            force=True,
-        )
+        DataWarehouse().sync_remote_table(self.data_source, self.table)
+        clear_query_plan_cache()
 
 
 def get_table_name(data_source, table):
@@ -10,6 +10,9 @@ from ibis import _
 from insights.insights.doctype.insights_data_source_v3.ibis_utils import (
     exec_with_return,
 )
+from insights.insights.doctype.insights_data_source_v3.query_plan_cache import (
+    clear_query_plan_cache,
+)
 from insights.insights.doctype.insights_table_v3.insights_table_v3 import get_table_name
 
 
@@ -181,6 +184,7 @@ def clear_cache():
     admin_team_members.clear_cache()
     is_admin.clear_cache()
     _get_allowed_resources_for_user.clear_cache()
+    clear_query_plan_cache()
 
 
 @site_cache(ttl=60 * 60 * 24)